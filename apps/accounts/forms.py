@@ -1,9 +1,9 @@
 # -*- coding:utf-8 -*-
 
-from flask import request
+from flask import current_app
+from utils.decorators import get_remote_addr
 from utils.forms import BaseForm, ValidateLength, ValidateVat, encode_email
 from wtforms import StringField, validators
-import requests
 
 
 class AccountForm(BaseForm):
@@ -19,16 +19,7 @@ class AccountForm(BaseForm):
 
     def validate_country(self, field):
         if not field.data:
-            remote_addr = request.remote_addr
-            if request.headers.getlist("X-Forwarded-For"):
-                remote_addr = request.headers.getlist("X-Forwarded-For")[0]
-
-            try:
-                response = requests.get('http://ip-api.com/json/{0}?fields=countryCode'.format(remote_addr))
-                response.raise_for_status()
-                field.data = response.json().get('countryCode')
-            except Exception:
-                pass
+            field.data = current_app.geoip.lookup(get_remote_addr())
 
         # Test if domain part is MX valid
         # Test if email is risky
@@ -3,18 +3,23 @@
 from flask import current_app, request
 from database import db
 from sqlalchemy import text
-from sqlalchemy.orm import relationship, backref
-from utils.models import ORModel, JsonSerializable
+from sqlalchemy.orm import relationship, backref, make_transient_to_detached
+from utils.models import ORModel, JsonSerializable, after_commit
 from utils.countries import get_country_name
-from utils.mailer import Mailgun
+from utils.customerio import CustomerIO
+from utils.hashing import HashingBusy
+from queues.mailer import enqueue
 from urllib.parse import urlparse
-import datetime, uuid, bcrypt
+import datetime, uuid
 
 
 class Account(db.Model, ORModel, JsonSerializable):
     __tablename__     = 'accounts'
     __jsonserialize__ = ['name', 'email', 'company_name', 'company_details', 'company_vat',
                          'get_country_display', 'country', 'created', 'locked', 'lock_reason']
+    # Columns kept by the authentication cache. The password is left out and lazy loaded when needed
+    __snapshot__      = ['id', 'uuid', 'name', 'email', 'company_name', 'company_details', 'company_vat',
+                         'country', 'created', 'removed', 'locked', 'lock_reason']
 
     id               = db.Column(db.Integer, primary_key=True)
     uuid             = db.Column(db.String(250), nullable=False, index=True, unique=True)  # Used mostly for Google Analytics or many other API
@@ -58,7 +63,7 @@ class Account(db.Model, ORModel, JsonSerializable):
 
     def set_password(self, password):
         if password is not None:
-            self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(12)).decode('utf-8')
+            self.password = current_app.password_hasher.hash(password.encode('utf-8'))
 
     def verify_password(self, password):
         if self.password is None:
@@ -73,7 +78,39 @@ class Account(db.Model, ORModel, JsonSerializable):
             except UnicodeEncodeError:
                 return False
 
-        return bcrypt.checkpw(password, self.password.encode('utf-8'))
+        return current_app.password_hasher.verify(password, self.password.encode('utf-8'))
+
+    def rehash_password(self, password):
+        """
+        Hashes the (verified) password again with BCRYPT_ROUNDS in the background,
+        the new hash being saved once done. Skipped when hashing is busy, done on a next login then
+        """
+        app = current_app._get_current_object()
+        account_id, previous = self.id, self.password
+
+        def save(future):
+            if future.exception() is not None:
+                app.logger.error('Unable to rehash the password of account {0}: {1}'.format(account_id, future.exception()))
+                return None
+
+            with app.app_context():
+                db.engine.execute(
+                    text('UPDATE accounts SET password = :password WHERE id = :account AND password = :previous'),
+                    password=future.result(),
+                    account=account_id,
+                    previous=previous
+                )
+
+        try:
+            current_app.password_hasher.hash_async(password.encode('utf-8')).add_done_callback(save)
+        except HashingBusy:
+            pass
+
+    def password_needs_rehash(self):
+        """
+        True when the password was hashed with a different cost than BCRYPT_ROUNDS
+        """
+        return self.has_password() and current_app.password_hasher.needs_rehash(self.password)
 
     def get_country_display(self):
         return get_country_name(self.country)
@@ -83,14 +120,60 @@ class Account(db.Model, ORModel, JsonSerializable):
 
         self.lock_reason = reason
         self.locked = datetime.datetime.utcnow()
+        account_id = self.id
+        if reason == 'ban' and account_id is not None:
+            # Logged out everywhere once committed
+            db.session.execute(text('DELETE FROM sessions WHERE account_id = :account'), {'account': account_id})
+            after_commit(lambda: current_app.token_resolver.revoke_account(account_id))
+        else:
+            after_commit(lambda: current_app.token_resolver.invalidate_account(account_id))
 
     def unlock(self):
         self.lock_reason = None
         self.locked = None
+        account_id = self.id
+        after_commit(lambda: current_app.token_resolver.invalidate_account(account_id))
+
+    def snapshot(self):
+        """
+        Returns a JSON friendly copy of the account, used to cache the authentication
+        """
+        data = {}
+        for column in self.__snapshot__:
+            value = getattr(self, column)
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+
+            data[column] = value
+
+        return data
+
+    @classmethod
+    def from_snapshot(cls, data):
+        """
+        Rebuilds an account attached to the current session from a snapshot, without querying the database
+        """
+        account = cls()
+        for column in cls.__snapshot__:
+            value = data.get(column)
+            if value is not None and isinstance(cls.__table__.columns[column].type, db.DateTime):
+                value = datetime.datetime.fromisoformat(value)
+
+            setattr(account, column, value)
+
+        make_transient_to_detached(account)
+        return db.session.merge(account, load=False)
 
     def save(self, commit=False):
+        db.session.add(self)
+        if self.id is None:
+            db.session.flush()  # The id is needed to sync the account
+
+        # Once committed, so a concurrent request can't cache the previous state again
+        account_id, data = self.id, self.serialize()
+        after_commit(lambda: current_app.token_resolver.invalidate_account(account_id))
+        after_commit(lambda: CustomerIO.account(account_id, data))
         super().save(commit)
-        # CustomerIO.account(self.id, self.serialize())
 
         """
         if self.stripe_id:
@@ -115,8 +198,9 @@ class Account(db.Model, ORModel, JsonSerializable):
         db.engine.execute(text('DELETE FROM sessions WHERE account_id = :account'), account=account_id)
         db.engine.execute(text('DELETE FROM api_keys WHERE account_id = :account'), account=account_id)
         db.engine.execute(text('DELETE FROM account_emails WHERE account_id = :account'), account=account_id)
+        current_app.token_resolver.revoke_account(account_id)
 
-        # CustomerIO.remove(account_id)
+        CustomerIO.remove(account_id)
 
         """
         stripe_row = db.engine.execute(text('SELECT stripe_id FROM accounts WHERE id = :account'), account=account_id).first()
@@ -151,6 +235,7 @@ class ApiKey(db.Model, ORModel, JsonSerializable):
     def disable(self):
         self.removed = datetime.datetime.utcnow()
         self.save(True)
+        current_app.token_resolver.invalidate_api_key(self.token)
 
     @classmethod
     def find_all(cls, account_id):
@@ -187,8 +272,6 @@ class AccountEmail(db.Model, ORModel):
         self.expires = datetime.datetime.utcnow() + datetime.timedelta(days=30)
         self.token = str(uuid.uuid4()).replace('-', '')
 
-        self.clear()
-
     def validate(self):
         has_changes = False
         if self.account.email != self.email:
@@ -203,7 +286,7 @@ class AccountEmail(db.Model, ORModel):
         if has_changes:
             self.account.save(True)
 
-        # CustomerIO.event(self.account.id, 'validate_email_successful', {'email': self.email})
+        CustomerIO.event(self.account.id, 'validate_email_successful', {'email': self.email})
         self.delete(True)
 
     def send(self, updated=False):
@@ -211,8 +294,7 @@ class AccountEmail(db.Model, ORModel):
             print('Login link: {0}'.format(self.get_link(updated)))
         else:
             # CustomerIO.event(self.account_id, 'validate_email', {'email': self.email, 'link': self.get_link(updated=updated)})
-            mail = Mailgun("Validate your account", "account/{}".format('update' if updated else 'validate'))
-            mail.send(self.account, {
+            enqueue(self.account, "Validate your account", "account/{}".format('update' if updated else 'validate'), {
                 'link': self.get_link(updated)
             })
 
@@ -232,13 +314,6 @@ class AccountEmail(db.Model, ORModel):
         else:
             return base_url + '/validate/{}'.format(self.token)
 
-    def clear(self):
-        """
-        We delete the previously created tokens that where created more than 4 hour ago
-        (in case the user request multiple tokens because of mail lagging)
-        """
-        db.engine.execute(text('DELETE FROM sessions WHERE account_id = :account AND expires < (UTC_TIMESTAMP() + INTERVAL 1 MONTH - INTERVAL 4 HOUR)'), account=self.account_id)
-
     @classmethod
     def find_by_token(cls, token):
         return cls.query.filter(cls.expires > datetime.datetime.utcnow()).filter(cls.token == token).first()
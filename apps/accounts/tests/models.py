@@ -0,0 +1,57 @@
+# coding:utf-8
+
+from flask import current_app
+from accounts.models import Account
+from database import db
+from tests import BaseTestCase
+
+
+class _Resolver(object):
+    """Records the invalidations instead of touching the caches"""
+    def __init__(self):
+        self.invalidated = []
+        self.revoked = []
+
+    def invalidate_account(self, account_id):
+        self.invalidated.append(account_id)
+
+    def revoke_account(self, account_id):
+        self.revoked.append(account_id)
+
+
+class AccountLockTest(BaseTestCase):
+    __display__ = 'Account lock'
+
+    def setUp(self):
+        self.resolver = current_app.token_resolver
+        current_app.token_resolver = _Resolver()
+        db.session.info.pop('after_commit', None)
+
+    def tearDown(self):
+        current_app.token_resolver = self.resolver
+        db.session.info.pop('after_commit', None)
+
+    def _commit(self):
+        # Runs the callbacks registered for the commit, without a database
+        for callback in db.session.info.pop('after_commit', []):
+            callback()
+
+    def test_lock_invalidates_cache(self):
+        account = Account(id=42)
+        account.lock('email')
+        self.assertEqual(current_app.token_resolver.invalidated, [])
+
+        self._commit()
+        self.assertIsNotNone(account.locked)
+        self.assertEqual(current_app.token_resolver.invalidated, [42])
+
+    def test_unlock_invalidates_cache(self):
+        account = Account(id=42)
+        account.lock('email')
+        self._commit()
+
+        account.unlock()
+        self._commit()
+        self.assertIsNone(account.locked)
+        self.assertIsNone(account.lock_reason)
+        self.assertEqual(current_app.token_resolver.invalidated, [42, 42])
@@ -2,12 +2,11 @@
 
 from flask import current_app, request
 from database import db
-from sqlalchemy import text
 from sqlalchemy.orm import relationship, backref
-from utils.models import ORModel
-from utils.mailer import Mailgun
+from utils.models import ORModel, after_commit
+from queues.mailer import enqueue
 from urllib.parse import urlparse
-import datetime, uuid
+import datetime
 
 
 class Session(db.Model, ORModel):
@@ -24,16 +23,14 @@ class Session(db.Model, ORModel):
     def __init__(self, account_id):
         self.account_id = account_id
         self.expires = datetime.datetime.utcnow() + datetime.timedelta(days=30)
-        self.token = str(uuid.uuid4()).replace('-', '')
-        self.clear()
+        self.token = current_app.token_resolver.issue_session(account_id, self.expires)
 
     def send(self):
         if current_app.debug:
             print('Login link: {0}'.format(self.get_link()))
         else:
             # CustomerIO.event(self.account_id, 'login_link', {'link': self.get_link()})
-            mail = Mailgun("Your {} access".format(current_app.config.get('APPLICATION_NAME')), "auth/one-time")
-            mail.send(self.account, {'link': self.get_link()})
+            enqueue(self.account, "Your {} access".format(current_app.config.get('APPLICATION_NAME')), "auth/one-time", {'link': self.get_link()})
 
     def get_link(self):
         base_url = None
@@ -48,12 +45,10 @@ class Session(db.Model, ORModel):
 
         return base_url + '/auth/{0}'.format(self.token)
 
-    def clear(self):
-        """
-        We delete the previously created tokens that where created more than 4 hour ago
-        (in case the user request multiple tokens because of mail lagging)
-        """
-        db.engine.execute(text('DELETE FROM sessions WHERE account_id = :account AND expires < (UTC_TIMESTAMP() + INTERVAL 1 MONTH - INTERVAL 4 HOUR)'), account=self.account_id)
+    def delete(self, commit=True):
+        token = self.token
+        after_commit(lambda: current_app.token_resolver.invalidate_session(token))
+        return super().delete(commit)
 
     @classmethod
     def find_by_token(cls, token):
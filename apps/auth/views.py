@@ -1,7 +1,7 @@
 # -*- coding:utf-8 -*-
 
-from flask import Blueprint, request, jsonify
-from utils.decorators import ratelimit
+from flask import Blueprint, current_app, request, jsonify
+from utils.decorators import authenticated, ratelimit
 from auth.forms import AuthForm, LostPasswordForm
 from accounts.models import Account
 from auth.models import Session
@@ -25,6 +25,10 @@ def login():
     if not account.verify_password(form.password.data):
         form.error('email', 'Invalid email/password credentials provided.')
 
+    if account.password_needs_rehash():
+        # The cost changed since the password was set, we have it in clear now so we upgrade it
+        account.rehash_password(form.password.data)
+
     ot = Session(account.id).save(True)
     return jsonify({
         'success': True,
@@ -52,3 +56,15 @@ def lost_password():
     return jsonify({
         'success': True
     })
+
+
+@app.route("/logout", methods=['POST'])
+@authenticated
+def logout():
+    """
+    Revoke the session token used to authenticate this request
+    """
+    current_app.token_resolver.revoke_session(request.headers.get('Authorization')[7:])
+    return jsonify({
+        'success': True
+    })
@@ -1,17 +1,66 @@
 # -*- coding:utf-8 -*-
 
-from flask import request, current_app
+from flask import request, current_app, g
+from werkzeug.local import LocalProxy
+from utils.decorators import get_remote_addr
+from urllib.parse import urlencode
 from random import random
-import requests, hashlib
+import hashlib
+
+
+def send_hits(client, hits):
+    """
+    Sends up to 20 hits at once through the Measurement Protocol batch endpoint
+    """
+    body = '\n'.join([urlencode(hit) for hit in hits])
+    client.post('ganalytics', 'https://www.google-analytics.com/batch', data=body).raise_for_status()
+
+
+def get_tracker():
+    """
+    Returns the tracker of the current request, built the first time it's used
+    """
+    tracker = g.get('_ga')
+    if tracker is None:
+        tracker = Tracker('app')
+        if g.get('_ga_disabled'):
+            tracker.tid = None  # Nothing will be sent
+        else:
+            tracker._load_from_request()
+
+        if g.get('_ga_uid') is not None:
+            tracker.set_uid(g._ga_uid)
+
+        g._ga = tracker
+
+    return tracker
+
+
+tracker = LocalProxy(get_tracker)
+
+
+def _disable_tracking():
+    g._ga_disabled = True
+
+
+def disable_tracking(blueprint):
+    """
+    Opts all the views of a blueprint out of tracking
+    """
+    blueprint.before_request(_disable_tracking)
+    return blueprint
 
 
 class Tracker(dict):
     """
     @see https://developers.google.com/analytics/devguides/collection/protocol/v1/parameters
     """
-    def __init__(self, ds='web'):
+    def __init__(self, ds='web', config=None):
+        if config is None:
+            config = current_app.config
+
         self.v = 1
-        self.tid = current_app.config.get('GOOGLE_ANALYTICS')  # UA-XXXX-Y
+        self.tid = config.get('GOOGLE_ANALYTICS')  # UA-XXXX-Y
         self.aip = 1
 
         # Data source
@@ -48,27 +97,28 @@ class Tracker(dict):
         self.el = None  # Label
         self.ev = None  # Value
 
-    def _load_from_request(self):
+    def _load_from_request(self, req=None, geoip=None):
+        """
+        req and geoip default to the ones of the current Flask request and application
+        """
+        req = req or request
+        geoip = geoip or current_app.geoip
+
         self.ds = 'web'
         self.ds = 'web'
-        remote_addr = request.remote_addr
-        if request.headers.getlist("X-Forwarded-For"):
-            remote_addr = request.headers.getlist("X-Forwarded-For")[0]
-
-        try:
-            response = requests.get('http://ip-api.com/json/{0}?fields=countryCode'.format(remote_addr))
-            response.raise_for_status()
-            self.geoid = response.json().get('countryCode')
-        except Exception:
+        remote_addr = get_remote_addr(req)
+
+        self.geoid = geoip.lookup(remote_addr)
+        if self.geoid is None:
             self.uip = remote_addr
 
-        self.ua = request.headers.get('user-agent')
-        self.ul = request.accept_languages.best
-        self.sr = request.args.get('sr', None)  # Screen resolution
-        self.vp = request.args.get('vp', None)  # View port
+        self.ua = req.headers.get('user-agent')
+        self.ul = req.accept_languages.best
+        self.sr = req.args.get('sr', None)  # Screen resolution
+        self.vp = req.args.get('vp', None)  # View port
 
-        if request.cookies.get('_t'):
-            self.cid = request.cookies.get('_t')
+        if req.cookies.get('_t'):
+            self.cid = req.cookies.get('_t')
 
         if not self.cid:
             seq = '{0}-{1}-{2}-{3}-{4}'.format(self.uip, self.ua, self.ul, self.sr, self.vp)
@@ -100,8 +150,11 @@ class Tracker(dict):
         self.uid = self._split_dash(value)
 
     def send(self):
+        """
+        Queues the hit, it is sent in the background by the dispatcher
+        """
         if self.tid is not None:
-            try:
-                requests.get('https://www.google-analytics.com/collect', params=self.__dict__).raise_for_status()
-            except Exception as e:
-                pass
+            current_app.ga_dispatcher.submit(self.payload())
+
+    def payload(self):
+        return {key: value for key, value in self.__dict__.items() if value is not None}
@@ -1,12 +1,23 @@
 # -*- coding:utf-8 -*-
 
-from flask import Blueprint, make_response, request, g
+from flask import Blueprint, make_response, request
 from functools import wraps
-from ganalytics.ga import Tracker
+from ganalytics.ga import tracker, send_hits
+from utils.dispatcher import BatchDispatcher, DiskSpool
 import base64, datetime
 
 app = Blueprint('ganalytics', __name__)
 
+PIXEL = base64.b64decode('R0lGODlhAQABAID/AMDAwAAAACH5BAEAAAAALAAAAAABAAEAAAICRAEA')
+PIXEL_HEADERS = [
+    ('Content-Type', 'image/gif'),
+    ('Cache-Control', 'private, no-cache, no-cache=Set-Cookie, proxy-revalidate'),
+    ('Expires', 'Wed, 11 Jan 2000 12:59:00 GMT'),
+    ('Last-Modified', 'Wed, 11 Jan 2006 12:59:00 GMT'),
+    ('Pragma', 'no-cache')
+]
+COOKIE_LIFETIME = datetime.timedelta(days=730)  # 2 years
+
 """
 Snippet:
 
@@ -38,10 +49,15 @@ Compressed:
 """
 
 
-@app.before_app_request
-def set_tracker():
-    g._ga = Tracker('app')
-    g._ga._load_from_request()
+@app.record_once
+def configure_dispatcher(state):
+    state.app.ga_dispatcher = BatchDispatcher(
+        'ganalytics',
+        lambda hits: send_hits(state.app.http, hits),  # Runs in the dispatcher thread, without application context
+        batch_size=20,  # Maximum allowed by the batch endpoint
+        maxsize=state.app.config.get('GA_QUEUE_SIZE'),
+        spool=DiskSpool(state.app.config.get('GA_SPILL_PATH')) if state.app.config.get('GA_SPILL_PATH') else None
+    )
 
 
 def pixel_response(view_func):
@@ -50,20 +66,17 @@ def pixel_response(view_func):
     """
     def _decorator(*args, **kwargs):
         view_func(*args, **kwargs)
-        g._ga.send()
+        tracker.send()
 
-        response = make_response(base64.b64decode('R0lGODlhAQABAID/AMDAwAAAACH5BAEAAAAALAAAAAABAAEAAAICRAEA'))
-        response.headers.set('Content-Type', 'image/gif')
-        response.headers.set("Cache-Control", "private, no-cache, no-cache=Set-Cookie, proxy-revalidate")
-        response.headers.set("Expires", "Wed, 11 Jan 2000 12:59:00 GMT")
-        response.headers.set("Last-Modified", "Wed, 11 Jan 2006 12:59:00 GMT")
-        response.headers.set("Pragma", "no-cache")
+        response = make_response(PIXEL)
+        for header, value in PIXEL_HEADERS:
+            response.headers.set(header, value)
 
         if request.cookies.get('_t') is None:
             response.set_cookie(
                 '_t',
-                g._ga.cid,
-                expires=datetime.datetime.now() + datetime.timedelta(days=730),  # 2 years
+                tracker.cid,
+                expires=datetime.datetime.now() + COOKIE_LIFETIME,
             )
         return response
 
@@ -73,7 +86,7 @@ def pixel_response(view_func):
 @app.route('/page.gif')
 @pixel_response
 def pageview():
-    g._ga.hit(
+    tracker.hit(
         'pageview',
         request.args.get('u', None) or request.headers.get('referer'),
         request.args.get('r', None),
@@ -84,7 +97,7 @@ def pageview():
 @pixel_response
 @app.route('/event.gif')
 def event():
-    g._ga.event(
+    tracker.event(
         request.args.get('c'),
         request.args.get('a'),
         request.args.get('l', None),
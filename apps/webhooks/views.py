@@ -2,10 +2,11 @@
 
 from flask import Blueprint, request, current_app, make_response, jsonify
 from accounts.models import Account
+from ganalytics.ga import disable_tracking
 import hmac, hashlib
 
 
-app = Blueprint('webhooks', __name__)
+app = disable_tracking(Blueprint('webhooks', __name__))
 
 
 @app.route('/customerio', methods=['POST'])
@@ -0,0 +1,99 @@
+# -*- coding:utf-8 -*-
+
+"""
+Encoding of the queued jobs: encode/decode throughput and size per job for each codec setting,
+plain JSON (the format before utils.codec) included.
+
+    python -m benchmarks.codec --jobs 100000
+With --redis, the jobs are also pushed to a list to measure the Redis memory used per 1M jobs
+(extrapolated from --jobs, the list is removed at the end):
+    python -m benchmarks.codec --jobs 100000 --redis redis://localhost:6379
+"""
+
+from utils import codec
+from utils.codec import Codec
+import argparse, datetime, json, time, uuid
+
+
+def _job(i):
+    return {
+        'account_id': i,
+        'subject': 'Your weekly report',
+        'template': 'account/report',
+        'substitution': {'firstname': 'Jane', 'count': i % 50, 'plan': 'business'},
+        'sent_at': datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=i),
+    }
+
+
+def _large_job(i):
+    job = _job(i)
+    job['substitution']['rows'] = [{'url': 'https://example.com/documents/{0}.pdf'.format(j), 'pages': j % 20} for j in range(100)]
+    return job
+
+
+class LegacyJSON(object):
+    """json.dumps / json.loads, as items were queued before"""
+    serializer, compression = 'json (legacy)', None
+
+    def encode(self, item):
+        return json.dumps(item, default=str)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+def _codecs():
+    codecs = [LegacyJSON(), Codec('json', None), Codec('json', 'zlib')]
+    if codec.msgpack is not None:
+        codecs += [Codec('msgpack', None), Codec('msgpack', 'zlib')]
+        if codec.zstandard is not None:
+            codecs.append(Codec('msgpack', 'zstd'))
+
+    return codecs
+
+
+def _redis_memory(connection, encoded):
+    """Bytes used by a list of the encoded jobs, per 1M jobs"""
+    key = 'benchmark-codec-{0}'.format(uuid.uuid4().hex[0:8])
+    try:
+        for i in range(0, len(encoded), 1000):
+            connection.rpush(key, *encoded[i:i + 1000])
+        return connection.memory_usage(key, samples=0) * 1000000 / len(encoded)
+    finally:
+        connection.delete(key)
+
+
+def run(name, factory, jobs, connection=None):
+    items = [factory(i) for i in range(jobs)]
+    print('{0} jobs ({1}):'.format(name, jobs))
+    print('{0:>24} {1:>12} {2:>12} {3:>10} {4:>14}'.format('', 'encode/sec', 'decode/sec', 'bytes/job', 'Redis MB/1M'))
+    for instance in _codecs():
+        started = time.perf_counter()
+        encoded = [instance.encode(item) for item in items]
+        encode = jobs / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for raw in encoded:
+            instance.decode(raw)
+        decode = jobs / (time.perf_counter() - started)
+
+        size = sum(len(raw) for raw in encoded) / jobs
+        memory = '{0:.0f}'.format(_redis_memory(connection, encoded) / 1024 / 1024) if connection is not None else '-'
+        print('{0:>24} {1:>12.0f} {2:>12.0f} {3:>10.0f} {4:>14}'.format(
+            '{0}/{1}'.format(instance.serializer, instance.compression), encode, decode, size, memory
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=100000)
+    parser.add_argument('--redis', default=None)
+    args = parser.parse_args()
+
+    connection = None
+    if args.redis:
+        import redis
+        connection = redis.from_url(args.redis)
+
+    run('Small', _job, args.jobs, connection)
+    run('Large', _large_job, max(args.jobs // 10, 1), connection)
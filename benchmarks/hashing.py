@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+
+"""
+Login throughput with bcrypt run in the worker (before) and through PasswordHasher (after).
+
+Each process stands for a sync worker verifying passwords in a loop; run with more processes
+than cores to see the effect of the host wide limit:
+    python -m benchmarks.hashing --processes 8 --logins 20 --rounds 12
+"""
+
+from multiprocessing import get_context
+from utils.hashing import PasswordHasher
+import argparse, bcrypt, os, tempfile, time
+
+
+def _worker(mode, rounds, logins, lock_path, results):
+    password = b'correct horse battery staple'
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    hasher = PasswordHasher(rounds, workers=1, wait=60, lock_path=lock_path)
+
+    latencies = []
+    for i in range(logins):
+        started = time.perf_counter()
+        if mode == 'before':
+            bcrypt.checkpw(password, hashed)
+        else:
+            hasher.verify(password, hashed)
+        latencies.append(time.perf_counter() - started)
+
+    results.put(latencies)
+
+
+def run(mode, processes, rounds, logins):
+    context = get_context('spawn')
+    results = context.Queue()
+    lock_path = os.path.join(tempfile.gettempdir(), 'benchmark-password-hash')
+    workers = [context.Process(target=_worker, args=(mode, rounds, logins, lock_path, results)) for i in range(processes)]
+
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+
+    latencies = sorted(sum([results.get() for worker in workers], []))
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+
+    cores = os.cpu_count() or 1
+    print('{0:>6}: {1:.1f} logins/sec, {2:.1f} per core, p50 {3:.0f}ms, p99 {4:.0f}ms'.format(
+        mode,
+        len(latencies) / elapsed,
+        len(latencies) / elapsed / cores,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99) - 1] * 1000
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=(os.cpu_count() or 1) * 2)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--logins', type=int, default=20)
+    args = parser.parse_args()
+
+    print('{0} processes, {1} cores, bcrypt cost {2}'.format(args.processes, os.cpu_count(), args.rounds))
+    for mode in ('before', 'after'):
+        run(mode, args.processes, args.rounds, args.logins)
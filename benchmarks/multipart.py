@@ -0,0 +1,76 @@
+# -*- coding:utf-8 -*-
+
+"""
+Peak memory (RSS) of building and reading a Mailgun multipart body, by attachment size,
+with the attachment loaded in memory (before) and streamed from its path by MultipartEncoder (after).
+
+Each measure runs in a new process, the body being read by 8 KiB blocks like http.client does:
+    python -m benchmarks.multipart --sizes 1,16,64,256
+The peak RSS of the streamed body should stay flat as the attachment grows.
+"""
+
+from multiprocessing import get_context
+import argparse, os, pathlib, resource, sys, tempfile
+
+
+def _peak_rss():
+    """In MiB, ru_maxrss being in KiB on Linux and bytes on macOS"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def _worker(mode, path, results):
+    from utils.multipart import MultipartEncoder
+    fields = {'from': 'Benchmark <benchmark@example.com>', 'to': 'someone@example.com', 'subject': 'Report', 'text': 'See attached'}
+    baseline = _peak_rss()
+
+    if mode == 'before':
+        with open(path, 'rb') as f:
+            source = f.read()
+    else:
+        source = pathlib.Path(path)
+
+    body = MultipartEncoder(fields, {'attachment[0]': ('report.bin', source, 'application/octet-stream')})
+    sent = 0
+    while True:
+        block = body.read(8192)
+        if not block:
+            break
+        sent += len(block)
+
+    results.put((sent, baseline, _peak_rss()))
+
+
+def run(mode, path):
+    context = get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_worker, args=(mode, path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,16,64,256', help='Attachment sizes in MiB, comma separated')
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>8} {2:>14} {3:>14}'.format('size MiB', 'mode', 'baseline MiB', 'peak MiB'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        f = tempfile.NamedTemporaryFile(prefix='benchmark-attachment-', delete=False)
+        try:
+            block = os.urandom(1024 * 1024)
+            for i in range(size):
+                f.write(block)
+            f.close()
+
+            for mode in ('before', 'after'):
+                sent, baseline, peak = run(mode, f.name)
+                print('{0:>10} {1:>8} {2:>14.1f} {3:>14.1f}'.format(size, mode, baseline, peak))
+        finally:
+            os.unlink(f.name)
+
+
+if __name__ == '__main__':
+    main()
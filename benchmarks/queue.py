@@ -0,0 +1,67 @@
+# -*- coding:utf-8 -*-
+
+"""
+Queue throughput against a local Redis: items/sec put and taken one by one (put / get)
+and by batches (put_many / get_many).
+
+    python -m benchmarks.queue --redis redis://localhost:6379 --items 100000 --batch 100
+The keys used are removed at the end.
+"""
+
+from utils.queue import RedisQueue
+import argparse, time, uuid
+
+
+def _job(i):
+    return {'account_id': i, 'subject': 'Your weekly report', 'template': 'account/report', 'substitution': {'count': i % 50}}
+
+
+def _rate(count, started):
+    return count / (time.perf_counter() - started)
+
+
+def run(queue, name, items, batch):
+    jobs = [_job(i) for i in range(items)]
+
+    started = time.perf_counter()
+    for job in jobs:
+        queue.put(name, job)
+    put = _rate(items, started)
+
+    started = time.perf_counter()
+    for i in range(items):
+        queue.get(name, timeout=1)
+    get = _rate(items, started)
+
+    started = time.perf_counter()
+    for i in range(0, items, batch):
+        queue.put_many(name, jobs[i:i + batch])
+    put_many = _rate(items, started)
+
+    started = time.perf_counter()
+    taken = 0
+    while taken < items:
+        taken += len(queue.get_many(name, batch, timeout=1))
+    get_many = _rate(items, started)
+
+    print('{0:>12} {1:>14} {2:>14}'.format('', 'put/sec', 'get/sec'))
+    print('{0:>12} {1:>14.0f} {2:>14.0f}'.format('single', put, get))
+    print('{0:>12} {1:>14.0f} {2:>14.0f}'.format('batch {0}'.format(batch), put_many, get_many))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redis', default='redis://localhost:6379')
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    namespace = 'benchmark-{0}'.format(uuid.uuid4().hex[0:8])
+    queue = RedisQueue(namespace, args.redis)
+    print('{0} items, codec {1}/{2}'.format(args.items, queue.codec.serializer, queue.codec.compression))
+    try:
+        run(queue, 'jobs', args.items, args.batch)
+    finally:
+        keys = list(queue.connection().scan_iter('{0}:*'.format(namespace)))
+        if keys:
+            queue.connection().delete(*keys)
@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+
+"""
+Latency of /ping and GET /account with the tracker built lazily (now) and before every request (before).
+Requests go through Flask, not the WSGI fast path. Uses the Testing configuration (database and Redis):
+    python -m benchmarks.tracker --requests 2000
+"""
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+from main import app_factory
+from database import db
+import argparse, base64, config, time
+
+
+def measure(client, path, headers, requests):
+    latencies = []
+    for i in range(requests):
+        started = time.perf_counter()
+        response = client.get(path, headers=headers)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000
+
+
+def build_tracker():
+    # What the set_tracker before_app_request hook did
+    from ganalytics.ga import tracker
+    tracker._get_current_object()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    app = app_factory(config=config.Testing)
+    client = Client(app.wsgi_app.wsgi_app, Response)  # Skips the fast path middleware
+
+    with app.app_context():
+        from accounts.models import Account, ApiKey
+        db.create_all()
+        account = Account.create(email='benchmark@example.com', uuid='benchmark')
+        account.save(True)
+        account_id = account.id
+        key = ApiKey(account_id).save(True)
+        headers = {'Authorization': 'Basic ' + base64.b64encode('api:{0}'.format(key.token).encode('utf-8')).decode('utf-8')}
+
+    try:
+        for mode in ('lazy', 'before'):
+            if mode == 'before':
+                app.before_request(build_tracker)
+
+            for path, path_headers in (('/ping', {}), ('/v1/account/', headers)):
+                measure(client, path, path_headers, 100)  # Warm up
+                p50, p99 = measure(client, path, path_headers, args.requests)
+                print('{0:>6} {1:<12} p50 {2:.3f}ms, p99 {3:.3f}ms'.format(mode, path, p50, p99))
+    finally:
+        with app.app_context():
+            Account.remove(account_id)
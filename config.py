@@ -25,6 +25,98 @@ class Config(object):
     SESSION_COOKIE_SECURE = True
     PERMANENT_SESSION_LIFETIME = timedelta(days=1)
 
+    # AUTHENTICATION CACHE (token -> account)
+    AUTH_CACHE_SIZE = 10000  # Entries kept in each process
+    AUTH_CACHE_LOCAL_TTL = 10  # Seconds, in process. Can't be invalidated from other processes
+    AUTH_CACHE_TTL = 300  # Seconds, in Redis
+
+    # Signed session tokens (HMAC with SECRET_KEY, required) are verified without reading the database
+    # Random tokens already issued keep working when enabled
+    SIGNED_TOKENS = False
+    TOKEN_REVOCATION_SYNC = 5  # Seconds between two syncs of the revoked tokens from Redis
+
+    # PASSWORD HASHING
+    BCRYPT_ROUNDS = 12  # Existing passwords are upgraded on login when this changes
+    PASSWORD_HASH_WORKERS = 1  # Processes of the bcrypt pool, per worker process. 0 hashes inline
+    PASSWORD_HASH_CONCURRENCY = None  # Hashes running at once on the host, all workers included. Defaults to the number of cores
+    PASSWORD_HASH_LOCK_PATH = None  # File locked to share that limit, defaults to /dev/shm/password-hash-<hash of the application path>
+    PASSWORD_HASH_WAIT = 5  # Seconds to wait for a slot before answering 503
+
+    # RATE LIMITING
+    RATELIMIT_ALGORITHM = 'gcra'  # gcra or sliding-window, with Redis
+    RATELIMIT_ACCOUNT = 60  # Requests per minute of an account on an authenticated endpoint (the limit given to the decorator applies per IP)
+    RATELIMIT_FAIL_OPEN = True  # When the limiter is unavailable, let the requests through (False answers 503)
+    # Without Redis, limits are shared between the workers of the host in a memory mapped file (GCRA only)
+    RATELIMIT_SHM_PATH = None  # Defaults to /dev/shm/ratelimit-<hash of the application path>, suffixed with the table geometry
+    RATELIMIT_SHM_BUCKETS = 4096  # 16 keys per bucket, 256 bytes each
+
+    # IP to country index, built with `manage.py geoip --source <csv>`
+    GEOIP_INDEX = os.path.join(APPLICATION_PATH, 'data', 'geoip.idx')
+
+    # Emails sent from the `mailer` queue are tried MAILER_ATTEMPTS times, waiting MAILER_BACKOFF seconds, doubled after each failure
+    MAILER_ATTEMPTS = 5
+    MAILER_BACKOFF = 2
+
+    # Compile every email template at startup (outside of debug)
+    EMAIL_TEMPLATES_PRECOMPILE = True
+
+    # OUTBOUND HTTP, per provider
+    HTTP_POOL_SIZE = 10  # Keep-alive connections per host, per process
+    HTTP_TIMEOUTS = {  # (connect, read) in seconds
+        'default':    (3, 10),  # noqa
+        'amplitude':  (3, 3),  # noqa
+        'customerio': (3, 3),
+        'ganalytics': (3, 5),
+        'mailgun':    (3, 20),  # noqa
+        'twilio':     (3, 10),  # noqa
+        'vies':       (3, 10),  # noqa
+    }
+    # Circuit breaker of each provider, see utils.httpclient.CircuitBreaker
+    HTTP_CIRCUIT = {
+        'failures': 5,  # Consecutive errors or slow responses opening the circuit
+        'reset_timeout': 30,  # Seconds before a request is tried again
+        'window': 200,  # Latencies kept to compute the p99
+        'multiplier': 2,  # Read timeout = p99 * multiplier, up to the one set in HTTP_TIMEOUTS
+        'minimum': 1
+    }
+    # Token required by /_internal/http (X-Introspection-Token header). Disabled if None
+    INTROSPECTION_TOKEN = None
+
+    # VIES answers, cached in the process and in Redis
+    VIES_CACHE_TTL = 86400  # Valid numbers
+    VIES_CACHE_NEGATIVE_TTL = 600  # Invalid numbers
+    VIES_CACHE_STALE_TTL = 7 * 86400  # Answers kept to be used when VIES is unavailable
+
+    # GOOGLE ANALYTICS hits are sent in the background
+    GA_QUEUE_SIZE = 10000  # Hits waiting to be sent, per process
+    GA_SPILL_PATH = None  # File where hits go when the queue is full. Dropped if None
+
+    # AMPLITUDE events are sent in the background, by batches
+    AMPLITUDE_BATCH_SIZE = 100
+    AMPLITUDE_FLUSH_INTERVAL = 5  # Maximum seconds an event waits for its batch to fill up
+    AMPLITUDE_QUEUE_SIZE = 10000  # Events waiting to be sent, per process
+    AMPLITUDE_SPOOL_PATH = None  # Without Redis, file keeping failed batches for retry. Dropped if None
+    AMPLITUDE_ATTEMPTS = 5  # Sends of an event before it's dropped
+
+    # CUSTOMERIO calls are queued in Redis and sent by `manage.py customerio_outbox`
+    # They are never made from a request: CustomerIO isn't updated when disabled, without Redis or without CUSTOMERIO_API_KEY
+    CUSTOMERIO_OUTBOX = True
+    CUSTOMERIO_OUTBOX_WINDOW = 30  # Seconds during which updates of an account are merged
+    CUSTOMERIO_OUTBOX_CONCURRENCY = 4  # Requests in flight in the worker
+
+    # Prefix of every Redis key (queues, caches, rate limits...), to share a Redis server between applications
+    REDIS_NAMESPACE = 'app'
+
+    # QUEUES workers (`manage.py queues`) with --concurrency take up to QUEUES_PREFETCH jobs per executor in advance
+    QUEUES_PREFETCH = 2
+    # Encoding of the queued jobs, see utils.codec.Codec (falls back to json / zlib when msgpack / zstandard are missing)
+    QUEUE_CODEC = {'serializer': 'msgpack', 'compression': 'zstd', 'threshold': 1024}
+    # With --reliable, jobs of workers silent for QUEUES_VISIBILITY_TIMEOUT seconds are requeued, and failed jobs
+    # are retried after QUEUES_BACKOFF seconds (doubled each time) until moved to <queue>:dead after QUEUES_MAX_ATTEMPTS
+    QUEUES_VISIBILITY_TIMEOUT = 60
+    QUEUES_BACKOFF = 10
+    QUEUES_MAX_ATTEMPTS = 5
+
     # ex: BLUEPRINTS = ['blog']  # where app is a Blueprint instance
     # ex: BLUEPRINTS = [('blog', {'url_prefix': '/myblog'})]  # where app is a Blueprint instance
 
@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from flask_script import Command, Option
+from utils.signals import GracefulInterruptHandler
+import time
+
+
+class CustomerioOutbox(Command):
+    """
+    Sends the CustomerIO calls queued in the outbox, with up to --concurrency requests in flight
+    """
+    option_list = (
+        Option('--concurrency', '-c', dest='concurrency', required=False, default=None, type=int),
+        Option('--batch', '-b', dest='batch', required=False, default=100, type=int),  # Accounts and actions per round
+        Option('--sleep', '-s', dest='sleep', required=False, default=1, type=float),  # Seconds to wait when idle
+    )
+
+    def run(self, concurrency=None, batch=100, sleep=1):
+        outbox = getattr(current_app, 'customerio_outbox', None)
+        if outbox is None:
+            current_app.logger.error('The CustomerIO outbox requires REDIS_URL, CUSTOMERIO_OUTBOX and CUSTOMERIO_API_KEY to be set.')
+            return None
+
+        concurrency = concurrency or current_app.config.get('CUSTOMERIO_OUTBOX_CONCURRENCY')
+        current_app.logger.info('Sending the CustomerIO outbox with {0} workers'.format(concurrency))
+        with GracefulInterruptHandler() as h, ThreadPoolExecutor(concurrency) as executor:
+            while not h.interrupted:
+                try:
+                    sent = outbox.drain(executor, batch, batch)
+                except Exception:
+                    current_app.logger.exception('Unable to drain the CustomerIO outbox')
+                    sent = 0
+
+                if sent == 0:
+                    time.sleep(sleep)
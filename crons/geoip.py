@@ -0,0 +1,26 @@
+# -*- coding:utf-8 -*-
+
+from flask import current_app
+from flask_script import Command, Option
+from utils.geoip import build_index
+import os, time
+
+
+class Geoip(Command):
+    """
+    Rebuild the GeoIP index from a CSV file of "start ip,end ip,country code" rows
+    (like the DB-IP or IP2Location "country lite" databases)
+    """
+    option_list = (
+        Option('--source', '-s', dest='source', required=True),
+        Option('--output', '-o', dest='output', required=False, default=None),  # Defaults to GEOIP_INDEX
+    )
+
+    def run(self, source, output=None):
+        output = output or current_app.config.get('GEOIP_INDEX')
+        if not os.path.isdir(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+
+        started = time.time()
+        v4, v6 = build_index(source, output)
+        current_app.logger.info('GeoIP index written to {0}: {1} IPv4 and {2} IPv6 entries in {3:.1f}s'.format(output, v4, v6, time.time() - started))
@@ -1,28 +1,136 @@
 # -*- coding:utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from flask import current_app
 from flask_script import Command, Option
 from werkzeug.utils import import_string
 from utils.signals import GracefulInterruptHandler
+import multiprocessing, os, random, signal, socket, threading, time, uuid
+
+_process_app = None
+
+
+def _run_job(app, name, params):
+    """
+    Runs a job in its own application context, and so its own DB session.
+    Returns False if it raised.
+    """
+    method = import_string('queues.{0}.process'.format(name))
+    with app.app_context():
+        app.logger.info("Got event :")
+        app.logger.info(params)
+
+        try:
+            method(**params)
+            return True
+        except Exception:
+            app.logger.exception('Exception in queue {0}'.format(name))
+            return False
+
+
+def _run_batch(app, name, items):
+    """Hands a list of jobs to the process_batch function of the queue"""
+    method = import_string('queues.{0}.process_batch'.format(name))
+    with app.app_context():
+        app.logger.info("Got {0} events".format(len(items)))
+
+        try:
+            method(items)
+            return True
+        except Exception:
+            app.logger.exception('Exception in queue {0} ({1} events)'.format(name, len(items)))
+            return False
+
+
+def _init_process():
+    # Interruptions are handled by the parent, which lets the running jobs finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    global _process_app
+    from main import app_factory
+    _process_app = app_factory()
+
+
+def _run_in_process(name, params):
+    return _run_job(_process_app, name, params)
+
+
+def _run_batch_in_process(name, items):
+    return _run_batch(_process_app, name, items)
 
 
 class Queues(Command):
     option_list = (
-        Option('--name', '-n', dest='name', required=True),
+        Option('--name', '-n', dest='name', required=True),  # queue[:weight[:limit]], comma separated
+        Option('--priority', dest='priority', required=False, default='strict', choices=('strict', 'weighted')),
+        Option('--concurrency', '-c', dest='concurrency', required=False, default=1, type=int),
+        Option('--mode', '-m', dest='mode', required=False, default='thread', choices=('thread', 'process')),
+        Option('--prefetch', '-p', dest='prefetch', required=False, default=None, type=int),  # Jobs fetched ahead of the executors
+        Option('--batch', '-b', dest='batch', required=False, default=None, type=int),  # Jobs per call to process_batch
+        Option('--reliable', '-r', dest='reliable', required=False, default=False, action='store_true'),
     )
 
     """
-    Execute a given queue
+    Execute the given queues.
+    Several queues can be consumed by one worker, "-n mailer:3:2,reports:1" meaning:
+      * mailer with a weight of 3 and at most 2 jobs running at once
+      * reports with a weight of 1 and no limit
+    With --priority strict (default), a queue is only consumed when the ones listed before it are empty.
+    With --priority weighted, queues are picked randomly in proportion to their weight.
+    Either way, the worker waits on all of them with a single BLPOP.
+
+    With --concurrency, jobs run in a pool of threads (I/O bound queues) or processes (CPU bound ones),
+    up to --prefetch jobs (QUEUES_PREFETCH per executor by default) being taken from Redis in advance.
+    When interrupted, running jobs are completed and the ones not started yet are put back in the queue.
+    With --batch, up to that many jobs are taken at once and given as a list to the process_batch
+    function of the queue module (prefetch then counts batches).
+    With --reliable, jobs are processed at least once: they stay in a processing list of the worker
+    until they complete, jobs raising are retried with a backoff then moved to the dead-letter list,
+    and the jobs of workers without heartbeat for QUEUES_VISIBILITY_TIMEOUT seconds are requeued.
+    --batch and --reliable take a single queue.
+    In every mode, delayed jobs (see RedisQueue.put) are moved to the queue when due, every second.
     """
-    def run(self, name):
-        method = import_string('queues.{0}.process'.format(name, ))
-        current_app.logger.info("Loading queue {0}".format(name))
+    promoted = 0
+
+    def run(self, name, priority='strict', concurrency=1, mode='thread', prefetch=None, batch=None, reliable=False):
+        queues = self.parse(name)
+        for queue in queues:
+            import_string('queues.{0}.{1}'.format(queue['name'], 'process_batch' if batch else 'process'))
+            current_app.logger.info("Loading queue {0}".format(queue['name']))
+
+        if len(queues) > 1:
+            if batch or reliable:
+                current_app.logger.error('--batch and --reliable take a single queue.')
+                return None
+
+            return self.run_pool(queues, max(concurrency, 1), mode, prefetch, priority=priority)
+
+        name = queues[0]['name']
+        if reliable:
+            if batch:
+                current_app.logger.error('--reliable can\'t be used with --batch.')
+                return None
+
+            return self.run_reliable(queues, max(concurrency, 1), mode, prefetch)
+
+        if concurrency > 1 or mode == 'process':
+            return self.run_pool(queues, concurrency, mode, prefetch, batch)
+
+        method = import_string('queues.{0}.{1}'.format(name, 'process_batch' if batch else 'process'))
         with GracefulInterruptHandler() as h:
             while True:
                 if h.interrupted:
                     return None
 
-                params = current_app.redis_queue.get(name)
+                self.promote(queues)
+                if batch:
+                    items = current_app.redis_queue.get_many(name, batch, timeout=1)
+                    if items:
+                        _run_batch(current_app._get_current_object(), name, items)
+                    continue
+
+                params = current_app.redis_queue.get(name, timeout=1)
                 if params is None:
                     continue
 
@@ -33,3 +141,176 @@ class Queues(Command):
                     method(**params)
                 except Exception:
                     current_app.logger.exception('Exception in queue {0}'.format(name))
+
+    def parse(self, names):
+        queues = []
+        for spec in names.split(','):
+            parts = spec.strip().split(':')
+            queues.append({
+                'name': parts[0],
+                'weight': float(parts[1]) if len(parts) > 1 and parts[1] else 1,
+                'limit': int(parts[2]) if len(parts) > 2 and parts[2] else None
+            })
+
+        return queues
+
+    def order(self, queues, priority):
+        """Names of the queues, in the order they should be consumed"""
+        if priority == 'weighted' and len(queues) > 1:
+            # Weighted random order (Efraimidis-Spirakis)
+            queues = sorted(queues, key=lambda queue: random.random() ** (1 / queue['weight']), reverse=True)
+
+        return [queue['name'] for queue in queues]
+
+    def run_pool(self, queues, concurrency, mode, prefetch, batch=None, priority='strict'):
+        def fetch(available):
+            if batch:
+                items = current_app.redis_queue.get_many(available[0]['name'], batch, timeout=1)
+                return (available[0]['name'], items) if items else None
+
+            return current_app.redis_queue.get_any(self.order(available, priority), timeout=1)
+
+        def requeue(name, items):
+            current_app.redis_queue.put_many(name, items if batch else [items])
+
+        self.consume(queues, concurrency, mode, prefetch, fetch, lambda name, items, success: None, requeue, batch)
+
+    def run_reliable(self, queues, concurrency, mode, prefetch):
+        app = current_app._get_current_object()
+        queue = app.redis_queue
+        config = app.config
+        name = queues[0]['name']
+        worker = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[0:8])
+        stopped = threading.Event()
+
+        def beat():
+            # Also requeues the jobs of the stalled workers
+            while not stopped.wait(config.get('QUEUES_VISIBILITY_TIMEOUT') / 3):
+                try:
+                    queue.heartbeat(name, worker)
+                    requeued = queue.reap(name, config.get('QUEUES_VISIBILITY_TIMEOUT'), config.get('QUEUES_MAX_ATTEMPTS'))
+                    if requeued:
+                        app.logger.warning('{0} jobs of stalled workers requeued'.format(requeued))
+                except Exception:
+                    app.logger.exception('Unable to send the heartbeat of {0}'.format(worker))
+
+        def fetch(available):
+            reserved = queue.reserve(name, worker, timeout=1)
+            return None if reserved is None else (name, reserved)
+
+        def complete(name, reserved, success):
+            if success:
+                queue.ack(name, worker, reserved[0])
+            elif not queue.fail(name, worker, reserved[0], config.get('QUEUES_MAX_ATTEMPTS'), config.get('QUEUES_BACKOFF')):
+                app.logger.error('Job moved to {0}:dead after {1} attempts: {2}'.format(name, config.get('QUEUES_MAX_ATTEMPTS'), reserved[1]))
+
+        def requeue(name, reserved):
+            queue.release(name, worker, reserved[0])
+
+        queue.heartbeat(name, worker)
+        heartbeat = threading.Thread(target=beat, name='heartbeat', daemon=True)
+        heartbeat.start()
+
+        current_app.logger.info('Worker {0} consuming {1} reliably'.format(worker, name))
+        try:
+            self.consume(queues, concurrency, mode, prefetch, fetch, complete, requeue, unwrap=lambda reserved: reserved[1])
+        finally:
+            stopped.set()
+            heartbeat.join()
+            requeued = queue.retire(name, worker)
+            if requeued:
+                app.logger.warning('{0} jobs still reserved by {1} put back in the queue'.format(requeued, worker))
+
+    def consume(self, queues, concurrency, mode, prefetch, fetch, complete, requeue, batch=None, unwrap=None):
+        """
+        Runs the jobs returned by fetch(available queues) as (queue name, job), None when there's none,
+        in a pool of executors. complete(queue name, job, success) is called once each is done,
+        and requeue(queue name, job) for the ones not started when interrupted.
+        """
+        prefetch = max(prefetch or concurrency * current_app.config.get('QUEUES_PREFETCH'), concurrency)
+        if mode == 'process':
+            executor = ProcessPoolExecutor(concurrency, mp_context=multiprocessing.get_context('spawn'), initializer=_init_process)
+        else:
+            executor = ThreadPoolExecutor(concurrency, thread_name_prefix='queue')
+
+        app = current_app._get_current_object()
+        slots = threading.Semaphore(prefetch)
+        pending = {}
+        running = {queue['name']: 0 for queue in queues}  # Jobs taken and not done yet, per queue
+        lock = threading.Lock()
+
+        def done(future):
+            with lock:
+                name, job = pending.pop(future, (None, None))
+                if name is not None:
+                    running[name] -= 1
+
+            try:
+                if job is not None and not future.cancelled():
+                    with app.app_context():
+                        complete(name, job, future.exception() is None and future.result())
+            finally:
+                slots.release()
+
+        current_app.logger.info('Running {0} {1}s, prefetching up to {2} jobs'.format(concurrency, mode, prefetch))
+        with GracefulInterruptHandler() as h:
+            while not h.interrupted:
+                self.promote(queues)
+                if not slots.acquire(timeout=1):
+                    continue
+
+                with lock:
+                    available = [queue for queue in queues if queue['limit'] is None or running[queue['name']] < queue['limit']]
+
+                if not available:
+                    # Every queue is at its limit
+                    slots.release()
+                    time.sleep(0.1)
+                    continue
+
+                fetched = fetch(available)
+                if fetched is None:
+                    slots.release()
+                    continue
+
+                name, job = fetched
+                params = unwrap(job) if unwrap else job
+                if batch and mode == 'process':
+                    future = executor.submit(_run_batch_in_process, name, params)
+                elif batch:
+                    future = executor.submit(_run_batch, app, name, params)
+                elif mode == 'process':
+                    future = executor.submit(_run_in_process, name, params)
+                else:
+                    future = executor.submit(_run_job, app, name, params)
+
+                with lock:
+                    pending[future] = (name, job)
+                    running[name] += 1
+                future.add_done_callback(done)
+
+        with lock:
+            waiting = list(pending.items())
+
+        requeued = 0
+        for future, (name, job) in waiting:
+            if future.cancel():
+                requeue(name, job)
+                requeued += 1
+
+        current_app.logger.info('Interrupted, {0} jobs put back in the queue. Waiting for the running ones.'.format(requeued))
+        executor.shutdown(wait=True)
+
+    def promote(self, queues):
+        """Moves the delayed jobs that are due to their queue, at most once per second"""
+        if time.time() - self.promoted < 1:
+            return None
+
+        self.promoted = time.time()
+        for queue in queues:
+            try:
+                promoted = current_app.redis_queue.promote(queue['name'])
+                if promoted:
+                    current_app.logger.info('{0} delayed jobs of {1} are due'.format(promoted, queue['name']))
+            except Exception:
+                current_app.logger.exception('Unable to promote the delayed jobs of {0}'.format(queue['name']))
@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+
+from flask import current_app
+from flask_script import Command, Option
+from sqlalchemy import text
+from database import db
+from utils.signals import GracefulInterruptHandler
+import time
+
+
+class SweepExpired(Command):
+    """
+    Delete the expired sessions and account emails, by chunks of primary keys.
+    If interrupted, the last id processed is logged so the sweep can be resumed with --from-id
+    """
+    tables = ('sessions', 'account_emails')
+
+    option_list = (
+        Option('--table', '-t', dest='table', required=False, default=None, choices=tables),
+        Option('--batch', '-b', dest='batch', required=False, default=1000, type=int),
+        Option('--sleep', '-s', dest='sleep', required=False, default=0.1, type=float),  # Seconds between batches
+        Option('--from-id', '-f', dest='from_id', required=False, default=0, type=int),  # Requires --table
+    )
+
+    def run(self, table=None, batch=1000, sleep=0.1, from_id=0):
+        if from_id and not table:
+            current_app.logger.error('--from-id requires --table to be set.')
+            return None
+
+        with GracefulInterruptHandler() as h:
+            for name in ([table] if table else self.tables):
+                if not self.sweep(name, batch, sleep, from_id, h):
+                    return None
+
+    def sweep(self, table, batch, sleep, from_id, handler):
+        last_id, deleted, started = from_id, 0, time.time()
+        current_app.logger.info('Sweeping expired rows from {0}, starting after id {1}'.format(table, from_id))
+
+        while True:
+            if handler.interrupted:
+                current_app.logger.info('Interrupted. Resume with --table {0} --from-id {1}'.format(table, last_id))
+                return False
+
+            rows = db.engine.execute(
+                text('SELECT id, token FROM {0} WHERE id > :last AND expires < UTC_TIMESTAMP() ORDER BY id LIMIT :batch'.format(table)),
+                last=last_id,
+                batch=batch
+            ).fetchall()
+
+            if not rows:
+                break
+
+            first_id, last_id = rows[0][0], rows[-1][0]
+            result = db.engine.execute(
+                text('DELETE FROM {0} WHERE id >= :first AND id <= :last AND expires < UTC_TIMESTAMP()'.format(table)),
+                first=first_id,
+                last=last_id
+            )
+            deleted += result.rowcount
+            if table == 'sessions':
+                current_app.token_resolver.invalidate_session(*[row[1] for row in rows])
+
+            elapsed = max(time.time() - started, 0.001)
+            current_app.logger.info('{0}: {1} rows deleted up to id {2} ({3:.0f} rows/sec)'.format(table, deleted, last_id, deleted / elapsed))
+            time.sleep(sleep)
+
+        elapsed = max(time.time() - started, 0.001)
+        current_app.logger.info('{0}: done, {1} rows deleted in {2:.1f}s ({3:.0f} rows/sec)'.format(table, deleted, elapsed, deleted / elapsed))
+        return True
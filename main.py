@@ -5,8 +5,9 @@ from flask import Flask, request, make_response, jsonify, abort, g
 from werkzeug.exceptions import HTTPException
 from werkzeug.routing import RequestRedirect
 from config import Config
+from utils.middleware import FastPathMiddleware, CORS_HEADERS
 from logging.handlers import SysLogHandler
-import os, sys, logging, socket
+import os, sys, logging, socket, hashlib, hmac, tempfile
 
 try:
     import sentry_sdk
@@ -51,6 +52,7 @@ def app_factory(app_name=None, blueprints=None, config=None):
     configure_extensions(app)
     configure_before_after_request(app)
     configure_views(app)
+    configure_middlewares(app)
 
     return app
 
@@ -176,11 +178,97 @@ def configure_template_filters(app):
     app.jinja_env.filters['price'] = import_string('utils.templates.price')
 
 
+def host_path(app, name):
+    """Path of a file shared by the processes of this application on the host"""
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    digest = hashlib.md5(app.config.get('APPLICATION_PATH').encode('utf-8')).hexdigest()[0:8]
+    return os.path.join(directory, '{0}-{1}'.format(name, digest))
+
+
 def configure_extensions(app):
     """Configure extensions like mail and login here"""
+    from utils.mailer import EmailTemplates
+    app.email_templates = EmailTemplates(
+        os.path.join(app.root_path, app.template_folder, 'emails'),
+        app.jinja_env,
+        auto_reload=app.debug
+    )
+    if app.config.get('EMAIL_TEMPLATES_PRECOMPILE') and not app.debug:
+        app.email_templates.precompile()
+
+    from utils.httpclient import HttpClient
+    app.http = HttpClient(app.config.get('HTTP_POOL_SIZE'), app.config.get('HTTP_TIMEOUTS'), app.config.get('HTTP_CIRCUIT'))
+
+    from utils.tokens import TokenResolver
+    if app.config.get('SIGNED_TOKENS') and not app.config.get('SECRET_KEY'):
+        raise ValueError('SIGNED_TOKENS requires a SECRET_KEY.')
+
+    app.token_resolver = TokenResolver(
+        app.config.get('AUTH_CACHE_SIZE'),
+        app.config.get('AUTH_CACHE_LOCAL_TTL'),
+        app.config.get('AUTH_CACHE_TTL'),
+        app.config.get('TOKEN_REVOCATION_SYNC')
+    )
+
+    from utils.geoip import GeoIP
+    app.geoip = GeoIP(app.config.get('GEOIP_INDEX'))
+
+    from utils.hashing import PasswordHasher
+    app.password_hasher = PasswordHasher(
+        app.config.get('BCRYPT_ROUNDS'),
+        app.config.get('PASSWORD_HASH_WORKERS'),
+        app.config.get('PASSWORD_HASH_CONCURRENCY'),
+        app.config.get('PASSWORD_HASH_WAIT'),
+        app.config.get('PASSWORD_HASH_LOCK_PATH') or host_path(app, 'password-hash')
+    )
+
     if app.config.get('REDIS_URL', None) is not None:
+        from utils.codec import Codec
         from utils.queue import RedisQueue
-        app.redis_queue = RedisQueue(app.config.get('REDIS_NAMESPACE'), app.config.get('REDIS_URL'))
+        from utils.ratelimit import RedisLimiter
+        app.redis_queue = RedisQueue(app.config.get('REDIS_NAMESPACE'), app.config.get('REDIS_URL'), Codec(**app.config.get('QUEUE_CODEC')))
+        app.rate_limiter = RedisLimiter(
+            app.redis_queue.connection(),
+            app.config.get('REDIS_NAMESPACE'),
+            app.config.get('RATELIMIT_ALGORITHM')
+        )
+
+        if app.config.get('CUSTOMERIO_OUTBOX') and app.config.get('CUSTOMERIO_API_KEY', None):
+            # Without the key, the calls would only pile up in Redis
+            from utils.customerio import CustomerIOOutbox
+            app.customerio_outbox = CustomerIOOutbox(
+                app.redis_queue.connection(),
+                app.config.get('REDIS_NAMESPACE'),
+                app.config.get('CUSTOMERIO_OUTBOX_WINDOW')
+            )
+    else:
+        from utils.ratelimit import SharedMemoryLimiter
+        app.rate_limiter = SharedMemoryLimiter(
+            app.config.get('RATELIMIT_SHM_PATH') or host_path(app, 'ratelimit'),
+            app.config.get('RATELIMIT_SHM_BUCKETS')
+        )
+
+    if app.config.get('AMPLITUDE_API_KEY', None) is not None:
+        from utils import send_amplitude_events
+        from utils.dispatcher import BatchDispatcher, DiskSpool, RedisSpool
+
+        spool = None
+        if hasattr(app, 'redis_queue'):
+            spool = RedisSpool(app.redis_queue.connection(), '{0}:amplitude:spool'.format(app.config.get('REDIS_NAMESPACE')))
+        elif app.config.get('AMPLITUDE_SPOOL_PATH'):
+            spool = DiskSpool(app.config.get('AMPLITUDE_SPOOL_PATH'))
+
+        api_key = app.config.get('AMPLITUDE_API_KEY')
+        app.amplitude = BatchDispatcher(
+            'amplitude',
+            lambda events: send_amplitude_events(app.http, api_key, events),
+            batch_size=app.config.get('AMPLITUDE_BATCH_SIZE'),
+            maxsize=app.config.get('AMPLITUDE_QUEUE_SIZE'),
+            linger=app.config.get('AMPLITUDE_FLUSH_INTERVAL'),
+            spool=spool,
+            retry_failed=True,
+            max_attempts=app.config.get('AMPLITUDE_ATTEMPTS')
+        )
 
 
 def configure_before_after_request(app):
@@ -213,9 +301,8 @@ def configure_before_after_request(app):
     def after_request_cors(response):
         """ Implementing CORS """
         h = response.headers
-        h.add('Access-Control-Allow-Origin', '*')
-        h.add('Access-Control-Allow-Methods', 'HEAD, GET, POST, PUT, DELETE, OPTIONS')
-        h.add('Access-Control-Allow-Headers', 'Origin, X-Requested-With, Content-Type, Accept, Host, Authorization')
+        for header, value in CORS_HEADERS:
+            h.add(header, value)
 
         return response
 
@@ -237,7 +324,32 @@ def configure_views(app):
     def ping():
         return 'Pong ({} v1)'.format(app.config.get('APPLICATION_NAME'))
 
+    @app.route('/_internal/http')
+    def http_introspection():
+        """State of the outbound HTTP calls, background dispatchers and email rendering of this process"""
+        token = app.config.get('INTROSPECTION_TOKEN')
+        # compare_digest only takes ASCII str
+        if not token or not hmac.compare_digest(request.headers.get('X-Introspection-Token', '').encode('utf-8'), token.encode('utf-8')):
+            abort(404)
+
+        dispatchers = {}
+        for name in ('ga_dispatcher', 'amplitude'):
+            if hasattr(app, name):
+                dispatchers[name] = getattr(app, name).stats()
+
+        return jsonify({
+            'pid': os.getpid(),
+            'providers': app.http.stats(),
+            'dispatchers': dispatchers,
+            'email_templates': app.email_templates.stats()
+        })
+
     """
     for rule in app.url_map.iter_rules():
         print(rule)
     """
+
+
+def configure_middlewares(app):
+    """WSGI middlewares, wrapping the Flask application"""
+    app.wsgi_app = FastPathMiddleware(app.wsgi_app, app)
@@ -0,0 +1,61 @@
+# -*- coding:utf-8 -*-
+
+from flask import current_app
+from utils.mailer import Mailgun
+
+QUEUE = 'mailer'
+
+
+def enqueue(account, subject, template, substitution=None):
+    """
+    Sends the email from the `mailer` queue (run with `manage.py queues -n mailer`),
+    or right away, with a single attempt, when Redis isn't configured
+    """
+    job = {
+        'account_id': account.id,
+        'subject': subject,
+        'template': template,
+        'substitution': substitution or {}
+    }
+
+    if hasattr(current_app, 'redis_queue'):
+        try:
+            current_app.redis_queue.put(QUEUE, job)
+            return None
+        except Exception:
+            current_app.logger.exception('[Mailer] Unable to queue the email, sending it now')
+
+    deliver(account, subject, template, substitution)
+
+
+def process(account_id, subject, template, substitution=None, attempt=1):
+    """
+    Failures are retried with an exponential backoff (MAILER_BACKOFF seconds, doubled after each attempt),
+    as delayed jobs so the worker doesn't wait
+    """
+    from accounts.models import Account
+    account = Account.query.filter(Account.id == account_id).filter(Account.removed == None).first()  # noqa
+    if account is None:
+        current_app.logger.warning('[Mailer] Account {0} not found, "{1}" not sent'.format(account_id, template))
+        return None
+
+    if deliver(account, subject, template, substitution):
+        return None
+
+    if attempt >= current_app.config.get('MAILER_ATTEMPTS'):
+        current_app.logger.error('[Mailer] Unable to send "{0}" to account {1} after {2} attempts'.format(template, account_id, attempt))
+        return None
+
+    current_app.redis_queue.put(QUEUE, {
+        'account_id': account_id,
+        'subject': subject,
+        'template': template,
+        'substitution': substitution or {},
+        'attempt': attempt + 1
+    }, delay=current_app.config.get('MAILER_BACKOFF') * 2 ** (attempt - 1))
+
+
+def deliver(account, subject, template, substitution=None):
+    """Sends the email, returns False when it failed"""
+    mail = Mailgun(subject, template)
+    return mail.send(account, dict(substitution or {})) is not None or Mailgun.is_mocked()
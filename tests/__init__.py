@@ -27,6 +27,10 @@ class BlueprintTesting():
 
                 self._fetch_directory('apps/%s/tests' % package, suite)
 
+            # Tests of the shared modules (utils, queues...)
+            if not self.blueprint or self.blueprint == 'utils':
+                self._fetch_directory('tests/utils', suite)
+
             return suite
 
     def _fetch_directory(self, directory, suite):
@@ -49,8 +53,10 @@ class BlueprintTesting():
                     self._load_suite(new_path, suite)
 
     def _load_suite(self, file, suite):
-        # We remove the "apps." at first, and then the ".py" ending
-        package = file.replace('/', '.')[5:-3]
+        # We remove the ".py" ending, and then the "apps." if any
+        package = file.replace('/', '.')[0:-3]
+        if package.startswith('apps.'):
+            package = package[5:]
         module = import_string(package)
         suite.addTest(unittest.findTestCases(module))
 
@@ -0,0 +1,94 @@
+# coding:utf-8
+
+from tests import BaseTestCase
+from utils.cache import LRUCache, SingleFlight
+import threading, time
+
+
+class LRUCacheTest(BaseTestCase):
+    __display__ = 'LRUCache'
+
+    def test_get_set(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 2), 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expires(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        cache.set('a', 1, ttl=0.05)
+        cache.set('b', 2)
+        time.sleep(0.1)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_delete(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        cache.set('a', {'account': 1})
+        cache.set('b', {'account': 2})
+        cache.set('c', {'account': 1})
+
+        cache.delete('b')
+        self.assertIsNone(cache.get('b'))
+
+        cache.delete_if(lambda value: value['account'] == 1)
+        self.assertEqual(len(cache), 0)
+
+
+class SingleFlightTest(BaseTestCase):
+    __display__ = 'SingleFlight'
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def load(value):
+            calls.append(value)
+            started.set()
+            release.wait(5)
+            return value * 2
+
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', load, 21)))
+        leader.start()
+        started.wait(5)
+
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', load, 21))) for i in range(4)]
+        for thread in followers:
+            thread.start()
+
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 5)
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            flight.do('key', fail)
+
+        # Nothing is kept once done
+        self.assertEqual(flight.do('key', lambda: 1), 1)
@@ -0,0 +1,87 @@
+# coding:utf-8
+
+from tests import BaseTestCase
+from utils import codec
+from utils.codec import Codec
+import datetime, json, unittest
+
+
+ITEM = {
+    'account_id': 42,
+    'subject': 'Héllo',
+    'ratio': 0.5,
+    'tags': ['a', 'b'],
+    'nested': {'none': None, 'flag': True},
+    'sent_at': datetime.datetime(2020, 1, 2, 3, 4, 5, 678000),
+}
+
+
+class CodecTest(BaseTestCase):
+    __display__ = 'Codec'
+
+    def _codecs(self):
+        codecs = [Codec('json', None), Codec('json', 'zlib', threshold=0)]
+        if codec.msgpack is not None:
+            codecs += [Codec('msgpack', None), Codec('msgpack', 'zlib', threshold=0)]
+        if codec.zstandard is not None:
+            codecs.append(Codec('json', 'zstd', threshold=0))
+
+        return codecs
+
+    def test_round_trip(self):
+        for instance in self._codecs():
+            raw = instance.encode(ITEM)
+            self.assertGreaterEqual(raw[0], 0x80)
+            self.assertEqual(instance.decode(raw), ITEM, '{0}/{1}'.format(instance.serializer, instance.compression))
+            # Whatever the settings of the decoding codec
+            self.assertEqual(Codec('json', None).decode(raw), ITEM)
+
+    def test_non_str_keys(self):
+        item = {'counts': {1: 5, 2: 3}}
+        for instance in self._codecs():
+            decoded = instance.decode(instance.encode(item))
+            if instance.serializer == 'msgpack':
+                self.assertEqual(decoded, item)
+            else:
+                # As json.dumps always did
+                self.assertEqual(decoded, {'counts': {'1': 5, '2': 3}})
+
+    def test_compression_threshold(self):
+        instance = Codec('json', 'zlib', threshold=100)
+        small, large = instance.encode({'a': 1}), instance.encode({'a': 'x' * 1000})
+        self.assertEqual(small[0] & 0x3, codec.COMPRESSIONS[None])
+        self.assertEqual(large[0] & 0x3, codec.COMPRESSIONS['zlib'])
+        self.assertLess(len(large), 1000)
+        self.assertEqual(instance.decode(large), {'a': 'x' * 1000})
+
+    def test_legacy_json(self):
+        instance = Codec()
+        self.assertEqual(instance.decode(json.dumps({'account_id': 42})), {'account_id': 42})
+        self.assertEqual(instance.decode(json.dumps({'subject': 'Héllo'}).encode('utf-8')), {'subject': 'Héllo'})
+        self.assertEqual(instance.decode(b'[1, 2]'), [1, 2])
+
+    def test_fallbacks(self):
+        instance = Codec('msgpack', 'zstd')
+        self.assertEqual(instance.serializer, 'msgpack' if codec.msgpack is not None else 'json')
+        self.assertEqual(instance.compression, 'zstd' if codec.zstandard is not None else 'zlib')
+
+        with self.assertRaises(ValueError):
+            Codec('pickle')
+
+    def test_invalid_items(self):
+        instance = Codec('json', 'zlib', threshold=0)
+        raw = instance.encode(ITEM)
+
+        with self.assertRaises(ValueError):
+            # Version 2
+            instance.decode(bytes([raw[0] & 0x8F | 2 << 4]) + raw[1:])
+
+        with self.assertRaises(ValueError):
+            instance.decode(raw[0:1] + b'corrupted')
+
+        with self.assertRaises(ValueError):
+            instance.decode(b'{"truncated": ')
+
+    @unittest.skipIf(codec.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_is_smaller(self):
+        self.assertLess(len(Codec('msgpack', None).encode(ITEM)), len(Codec('json', None).encode(ITEM)))
@@ -0,0 +1,37 @@
+# coding:utf-8
+
+from tests import BaseTestCase
+from utils.dispatcher import BatchDispatcher
+
+
+class _Spool(object):
+    def __init__(self):
+        self.items = []
+
+    def push(self, items):
+        self.items += items
+
+
+def _fail(items):
+    raise ConnectionError('Service unavailable')
+
+
+class BatchDispatcherTest(BaseTestCase):
+    __display__ = 'BatchDispatcher'
+
+    def test_failed_batch_spooled(self):
+        spool = _Spool()
+        dispatcher = BatchDispatcher('test', _fail, spool=spool, retry_failed=True)
+        dispatcher._send([(0, {'id': 1}), (0, {'id': 2})])
+
+        self.assertEqual(spool.items, [{'__attempts__': 1, '__item__': {'id': 1}}, {'__attempts__': 1, '__item__': {'id': 2}}])
+        self.assertEqual(dispatcher.stats()['dropped'], 0)
+
+    def test_failed_batch_without_spool(self):
+        dispatcher = BatchDispatcher('test', _fail, retry_failed=True)
+        dispatcher._send([(0, {'id': 1}), (4, {'id': 2})])
+
+        stats = dispatcher.stats()
+        self.assertEqual(stats['failed'], 2)
+        # One after max_attempts, one that can't be spooled
+        self.assertEqual(stats['dropped'], 2)
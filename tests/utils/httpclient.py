@@ -0,0 +1,127 @@
+# coding:utf-8
+
+from tests import BaseTestCase
+from utils.httpclient import CircuitBreaker, CircuitOpenError, HttpClient
+import threading, time
+
+
+class CircuitBreakerTest(BaseTestCase):
+    __display__ = 'CircuitBreaker'
+
+    def _open(self, breaker):
+        for i in range(breaker.failures):
+            breaker.failure()
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failures=3, reset_timeout=60)
+        breaker.failure()
+        breaker.failure()
+        breaker.success(0.1, 10)  # Resets the count
+        breaker.failure()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.trips, 1)
+
+    def test_slow_responses_count_as_failures(self):
+        breaker = CircuitBreaker(failures=2, reset_timeout=60)
+        breaker.success(5, 1)
+        breaker.success(5, 1)
+        self.assertEqual(breaker.state, 'open')
+
+    def test_half_open_single_probe(self):
+        breaker = CircuitBreaker(failures=1, reset_timeout=0.05)
+        self._open(breaker)
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertFalse(breaker.allow())
+
+        breaker.success(0.1, 10)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failures=1, reset_timeout=0.05)
+        self._open(breaker)
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+    def test_release_probe(self):
+        breaker = CircuitBreaker(failures=1, reset_timeout=0.05)
+        self._open(breaker)
+        time.sleep(0.1)
+        self.assertTrue(breaker.allow())
+
+        # Only the thread making the probe can release it
+        other = threading.Thread(target=breaker.release)
+        other.start()
+        other.join()
+        self.assertFalse(breaker.allow())
+
+        breaker.release()
+        self.assertTrue(breaker.allow())
+
+    def test_read_timeout(self):
+        breaker = CircuitBreaker(multiplier=2, minimum=1)
+        breaker.success(0.1, 10)
+        self.assertEqual(breaker.read_timeout(10), 10)  # Not enough samples
+
+        for i in range(100):
+            breaker.success(2, 10)
+        self.assertEqual(breaker.read_timeout(10), 4)
+
+        for i in range(200):
+            breaker.success(0.01, 10)
+        self.assertEqual(breaker.read_timeout(10), 1)
+        self.assertEqual(breaker.read_timeout(0.5), 0.5)
+
+    def test_unsampled_success(self):
+        breaker = CircuitBreaker(failures=1)
+        breaker.success(None, 1)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.read_timeout(10), 10)
+
+
+class BrokenSession(object):
+    def request(self, method, url, **kwargs):
+        raise ValueError('Not a RequestException')
+
+
+class HttpClientTest(BaseTestCase):
+    __display__ = 'HttpClient'
+
+    def test_probe_released_on_any_exception(self):
+        client = HttpClient(circuit={'failures': 1, 'reset_timeout': 0.05})
+        client._session = lambda provider: BrokenSession()
+        client.breaker('test').failure()
+
+        with self.assertRaises(CircuitOpenError):
+            client.get('test', 'http://localhost/')
+
+        time.sleep(0.1)
+        for i in range(2):
+            # Each call gets to probe, the previous one having been released
+            with self.assertRaises(ValueError):
+                client.get('test', 'http://localhost/')
+
+    def test_large_bodies_use_the_configured_timeout(self):
+        client = HttpClient(timeouts={'default': (3, 10)}, circuit={'minimum': 0.1})
+        for i in range(50):
+            client.breaker('test').success(0.1, 10)
+
+        self.assertEqual(client.timeout('test'), (3, 0.2))
+        self.assertTrue(client._is_large({'data': b'x' * (client.large_body + 1)}))
+        self.assertTrue(client._is_large({'data': iter([b'x'])}))
+        self.assertFalse(client._is_large({'data': b'x'}))
+        self.assertFalse(client._is_large({'json': {'a': 1}}))
+        self.assertEqual(client.timeout('test', adaptive=False), (3, 10))
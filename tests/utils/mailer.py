@@ -0,0 +1,54 @@
+# coding:utf-8
+
+from tests import BaseTestCase
+from utils.mailer import Mailgun
+import json
+
+
+class _Recipient(object):
+    def __init__(self, name, email):
+        self.name = name
+        self.email = email
+
+    def __str__(self):
+        return self.name
+
+
+class _Mailgun(Mailgun):
+    """Keeps the requests instead of posting them"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.posted = []
+
+    def _post(self, data):
+        self.posted.append(dict(data))
+        return {}
+
+
+class MailgunBulkTest(BaseTestCase):
+    __display__ = 'Mailgun.send_bulk'
+
+    def test_recipient_variables(self):
+        mail = _Mailgun('Hi {{ firstname }}', text='Hello {{ name }}', html='<p>Hello {{ name }}</p>')
+        result = mail.send_bulk([
+            _Recipient('Jane Doe', 'jane@example.com'),
+            _Recipient('<b>Joe</b>', 'joe@example.com'),
+            _Recipient('No email', None),
+        ])
+        self.assertEqual(result, {'sent': 2, 'failed': 0})
+
+        data = mail.posted[0]
+        self.assertEqual(data['to'], ['Jane Doe <jane@example.com>', 'bJoe/b <joe@example.com>'])
+        variables = json.loads(data['recipient-variables'])
+        # Keyed by the bare addresses of `to`
+        self.assertEqual(sorted(variables.keys()), ['jane@example.com', 'joe@example.com'])
+        self.assertEqual(variables['jane@example.com']['name'], 'Jane Doe')
+        self.assertEqual(variables['joe@example.com']['name__html'], '&lt;b&gt;Joe&lt;/b&gt;')
+
+        self.assertEqual(data['text'], 'Hello %recipient.name%')
+        self.assertEqual(data['html'], '<p>Hello %recipient.name__html%</p>')
+
+    def test_filtered_variables(self):
+        mail = _Mailgun('Hi', text='Hello {{ name|upper }}')
+        with self.assertRaises(ValueError):
+            mail.send_bulk([_Recipient('Jane Doe', 'jane@example.com')])
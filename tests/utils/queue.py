@@ -0,0 +1,154 @@
+# coding:utf-8
+
+from flask import current_app
+from tests import BaseTestCase
+from utils.codec import Codec
+from utils.queue import RedisQueue
+import datetime, json, time, unittest, uuid
+
+
+class RedisQueueTestCase(BaseTestCase):
+    def setUp(self):
+        try:
+            current_app.redis_queue.connection().ping()
+        except Exception:
+            raise unittest.SkipTest('Redis is not available')
+
+        self.namespace = 'test-{0}'.format(uuid.uuid4().hex)
+        self.queue = RedisQueue(self.namespace, current_app.config.get('REDIS_URL'), Codec('json', None))
+        self.connection = self.queue.connection()
+
+    def tearDown(self):
+        keys = self.connection.keys('{0}:*'.format(self.namespace))
+        if keys:
+            self.connection.delete(*keys)
+
+    def _key(self, suffix=None):
+        return '{0}:jobs'.format(self.namespace) + (':{0}'.format(suffix) if suffix else '')
+
+
+class RedisQueueTest(RedisQueueTestCase):
+    __display__ = 'RedisQueue'
+
+    def test_get_any(self):
+        self.queue.put('jobs', {'id': 1})
+        self.queue.put('reports', {'id': 2})
+        self.assertEqual(self.queue.get_any(['reports', 'jobs'], timeout=1), ('reports', {'id': 2}))
+        self.assertEqual(self.queue.get_any(['reports', 'jobs'], timeout=1), ('jobs', {'id': 1}))
+        self.assertIsNone(self.queue.get_any(['reports', 'jobs'], timeout=1))
+
+
+class DelayedQueueTest(RedisQueueTestCase):
+    __display__ = 'RedisQueue (delayed)'
+
+    def test_promote_when_due(self):
+        self.queue.put('jobs', {'id': 1}, delay=60)
+        self.queue.put('jobs', {'id': 2}, eta=datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+        self.queue.put('jobs', {'id': 3}, eta=time.time() + 60)
+        self.assertEqual(self.connection.llen(self._key()), 0)
+        self.assertEqual(self.connection.zcard(self._key('delayed')), 3)
+
+        self.assertEqual(self.queue.promote('jobs'), 1)
+        self.assertEqual(self.queue.get_many('jobs', 10, timeout=0), [{'id': 2}])
+        self.assertEqual(self.queue.promote('jobs'), 0)
+        self.assertEqual(self.connection.zcard(self._key('delayed')), 2)
+
+    def test_identical_items(self):
+        for i in range(2):
+            self.queue.put('jobs', {'id': 1}, eta=time.time() - 1)
+
+        self.assertEqual(self.queue.promote('jobs'), 2)
+        self.assertEqual(self.queue.get_many('jobs', 10, timeout=0), [{'id': 1}, {'id': 1}])
+
+    def test_promote_by_batches(self):
+        for i in range(5):
+            self.queue.put('jobs', {'id': i}, eta=time.time() - 10 + i)
+
+        self.assertEqual(self.queue.promote('jobs', limit=2), 5)
+        self.assertEqual(self.queue.get_many('jobs', 10, timeout=0), [{'id': i} for i in range(5)])
+        self.assertEqual(self.connection.zcard(self._key('delayed')), 0)
+
+
+class ReliableQueueTest(RedisQueueTestCase):
+    __display__ = 'RedisQueue (reliable)'
+
+    def test_reserve_ack(self):
+        self.queue.put('jobs', {'id': 1})
+        raw, item = self.queue.reserve('jobs', 'worker-1', timeout=1)
+        self.assertEqual(item, {'id': 1})
+        self.assertEqual(self.connection.llen(self._key()), 0)
+        self.assertEqual(self.connection.lrange(self.queue._processing('jobs', 'worker-1'), 0, -1), [raw])
+
+        self.queue.ack('jobs', 'worker-1', raw)
+        self.assertEqual(self.connection.llen(self.queue._processing('jobs', 'worker-1')), 0)
+        self.assertIsNone(self.queue.reserve('jobs', 'worker-1', timeout=1))
+
+    def test_fail_retries_then_dead(self):
+        self.queue.put('jobs', {'id': 1})
+        for attempt in range(1, 4):
+            raw, item = self.queue.reserve('jobs', 'worker-1', timeout=1)
+            retried = self.queue.fail('jobs', 'worker-1', raw, max_attempts=3, backoff=60)
+            self.assertEqual(retried, attempt < 3)
+            if retried:
+                # Waiting for its backoff, made due right away
+                self.assertEqual(self.connection.zcard(self._key('delayed')), 1)
+                self.assertEqual(self.queue.promote('jobs'), 0)
+                for member in self.connection.zrange(self._key('delayed'), 0, -1):
+                    self.connection.zadd(self._key('delayed'), {member: 0})
+                self.assertEqual(self.queue.promote('jobs'), 1)
+
+        self.assertEqual(self.connection.lrange(self._key('dead'), 0, -1), [raw])
+        self.assertEqual(self.connection.hlen(self._key('attempts')), 0)
+
+    def test_identical_jobs_are_counted_apart(self):
+        self.queue.put_many('jobs', [{'id': 1}, {'id': 1}])
+        first, second = self.queue.reserve('jobs', 'worker-1', timeout=1), self.queue.reserve('jobs', 'worker-1', timeout=1)
+        self.assertEqual(first[1], second[1])
+        self.assertNotEqual(first[0], second[0])
+
+        self.queue.fail('jobs', 'worker-1', first[0], max_attempts=2, backoff=60)
+        self.queue.fail('jobs', 'worker-1', second[0], max_attempts=2, backoff=60)
+        self.assertEqual(self.connection.llen(self._key('dead')), 0)
+        self.assertEqual(self.connection.zcard(self._key('delayed')), 2)
+
+    def test_reap_stalled_worker(self):
+        self.queue.put_many('jobs', [{'id': 1}, {'id': 2}])
+        self.queue.heartbeat('jobs', 'stalled')
+        self.queue.heartbeat('jobs', 'alive')
+        self.connection.zadd(self._key('workers'), {'stalled': 0})
+        stalled = self.queue.reserve('jobs', 'stalled', timeout=1)
+        alive = self.queue.reserve('jobs', 'alive', timeout=1)
+
+        self.assertEqual(self.queue.reap('jobs', 60, max_attempts=2), 1)
+        self.assertEqual(self.connection.lrange(self._key(), 0, -1), [stalled[0]])
+        self.assertEqual(self.connection.lrange(self.queue._processing('jobs', 'alive'), 0, -1), [alive[0]])
+        self.assertEqual(self.connection.zrange(self._key('workers'), 0, -1), [b'alive'])
+
+        # Same job id in Lua and in Python: the second stall is its last attempt
+        self.queue.reserve('jobs', 'stalled', timeout=1)
+        self.queue.heartbeat('jobs', 'stalled')
+        self.connection.zadd(self._key('workers'), {'stalled': 0})
+        self.assertEqual(self.queue.reap('jobs', 60, max_attempts=2), 0)
+        self.assertEqual(self.connection.lrange(self._key('dead'), 0, -1), [stalled[0]])
+        self.assertEqual(self.connection.hlen(self._key('attempts')), 0)
+
+    def test_retire_requeues_reserved_items(self):
+        self.queue.put_many('jobs', [{'id': 1}, {'id': 2}, {'id': 3}])
+        self.queue.heartbeat('jobs', 'worker-1')
+        for i in range(2):
+            self.queue.reserve('jobs', 'worker-1', timeout=1)
+
+        self.assertEqual(self.queue.retire('jobs', 'worker-1'), 2)
+        self.assertEqual(self.connection.llen(self.queue._processing('jobs', 'worker-1')), 0)
+        self.assertEqual(self.connection.zcard(self._key('workers')), 0)
+        self.assertEqual(self.queue.get_many('jobs', 10, timeout=0), [{'id': 1}, {'id': 2}, {'id': 3}])
+        self.assertEqual(self.connection.hlen(self._key('attempts')), 0)
+
+    def test_legacy_items(self):
+        # Queued before job ids, as plain JSON
+        self.connection.rpush(self._key(), json.dumps({'id': 1}))
+        raw, item = self.queue.reserve('jobs', 'worker-1', timeout=1)
+        self.assertEqual(item, {'id': 1})
+
+        self.assertTrue(self.queue.fail('jobs', 'worker-1', raw, max_attempts=2, backoff=60))
+        self.assertEqual(self.connection.hlen(self._key('attempts')), 1)
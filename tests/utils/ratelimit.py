@@ -0,0 +1,112 @@
+# coding:utf-8
+
+from flask import current_app
+from tests import BaseTestCase
+from utils.ratelimit import RedisLimiter, SharedMemoryLimiter
+import os, shutil, tempfile, time, unittest, uuid
+
+
+class RedisLimiterTest(BaseTestCase):
+    __display__ = 'RedisLimiter'
+
+    def setUp(self):
+        try:
+            self.connection = current_app.redis_queue.connection()
+            self.connection.ping()
+        except Exception:
+            raise unittest.SkipTest('Redis is not available')
+
+        self.prefix = 'test-{0}'.format(uuid.uuid4().hex)
+
+    def tearDown(self):
+        keys = self.connection.keys('{0}*'.format(self.prefix))
+        if keys:
+            self.connection.delete(*keys)
+
+    def _check_limit(self, algorithm):
+        limiter = RedisLimiter(self.connection, algorithm=algorithm)
+        key = '{0}/ip'.format(self.prefix)
+
+        results = [limiter.check([(key, 3)]) for i in range(4)]
+        self.assertEqual([r.over_limit for r in results], [False, False, False, True])
+        self.assertEqual(results[0].limit, 3)
+        self.assertEqual(results[0].remaining, 2)
+        self.assertGreater(results[3].reset, time.time())
+
+    def test_gcra(self):
+        self._check_limit('gcra')
+
+    def test_sliding_window(self):
+        self._check_limit('sliding-window')
+
+    def test_denied_request_is_not_recorded(self):
+        for algorithm in ('gcra', 'sliding-window'):
+            limiter = RedisLimiter(self.connection, algorithm=algorithm)
+            ip, account = '{0}/{1}/ip'.format(self.prefix, algorithm), '{0}/{1}/account'.format(self.prefix, algorithm)
+
+            self.assertFalse(limiter.check([(account, 1)]).over_limit)
+            # The account is over its limit, the IP must not be charged for it
+            self.assertTrue(limiter.check([(ip, 2), (account, 1)]).over_limit)
+            self.assertFalse(limiter.check([(ip, 2)]).over_limit)
+            self.assertFalse(limiter.check([(ip, 2)]).over_limit)
+            self.assertTrue(limiter.check([(ip, 2)]).over_limit)
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            RedisLimiter(self.connection, algorithm='fixed-window')
+
+
+class SharedMemoryLimiterTest(BaseTestCase):
+    __display__ = 'SharedMemoryLimiter'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ratelimit')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_limit(self):
+        limiter = SharedMemoryLimiter(self.path, buckets=16)
+        results = [limiter.check([('ip', 3)]) for i in range(4)]
+
+        self.assertEqual([r.over_limit for r in results], [False, False, False, True])
+        self.assertEqual(results[0].remaining, 2)
+        self.assertGreater(results[3].reset, time.time())
+
+    def test_denied_request_is_not_recorded(self):
+        limiter = SharedMemoryLimiter(self.path, buckets=16)
+        self.assertFalse(limiter.check([('account', 1)]).over_limit)
+        self.assertTrue(limiter.check([('ip', 2), ('account', 1)]).over_limit)
+        self.assertFalse(limiter.check([('ip', 2)]).over_limit)
+        self.assertFalse(limiter.check([('ip', 2)]).over_limit)
+        self.assertTrue(limiter.check([('ip', 2)]).over_limit)
+
+    def test_shared_between_processes(self):
+        SharedMemoryLimiter(self.path, buckets=16).check([('ip', 2)])
+
+        pid = os.fork()
+        if pid == 0:
+            # Same file, new mapping: the request made by the parent is seen
+            limited = SharedMemoryLimiter(self.path, buckets=16).check([('ip', 2)], period=60)
+            os._exit(0 if not limited.over_limit else 1)
+
+        os.waitpid(pid, 0)
+        self.assertTrue(SharedMemoryLimiter(self.path, buckets=16).check([('ip', 2)]).over_limit)
+
+    def test_full_bucket_evicts(self):
+        limiter = SharedMemoryLimiter(self.path, buckets=1, ways=2)
+        for key in ('a', 'b', 'c'):
+            self.assertFalse(limiter.check([(key, 1)]).over_limit)
+
+    def test_other_geometry_uses_another_file(self):
+        SharedMemoryLimiter(self.path, buckets=16).check([('ip', 1)])
+        self.assertFalse(SharedMemoryLimiter(self.path, buckets=32).check([('ip', 1)]).over_limit)
+
+    def test_refuses_mismatched_file(self):
+        limiter = SharedMemoryLimiter(self.path, buckets=16)
+        with open(limiter.path, 'wb') as f:
+            f.write(b'\0' * 100)
+
+        with self.assertRaises(ValueError):
+            limiter.check([('ip', 1)])
@@ -0,0 +1,115 @@
+# coding:utf-8
+
+from tests import BaseTestCase
+from utils.tokens import sign_token, read_token, is_signed, _signature, BloomFilter, RevocationFilter
+import time
+
+
+class LocalRevocationFilter(RevocationFilter):
+    """Keeps the revocations in the process, whether Redis is configured or not"""
+    def _redis(self):
+        return None
+
+
+class BrokenRedis(object):
+    def pipeline(self):
+        raise ConnectionError('Redis is down')
+
+    def zscore(self, key, member):
+        raise ConnectionError('Redis is down')
+
+
+class BrokenRevocationFilter(RevocationFilter):
+    def _redis(self):
+        return BrokenRedis()
+
+    def _key(self):
+        return 'auth:revoked'
+
+
+class SignedTokenTest(BaseTestCase):
+    __display__ = 'Signed tokens'
+    secret = 'secret'
+
+    def test_round_trip(self):
+        expires = int(time.time()) + 3600
+        token = sign_token(self.secret, 42, expires)
+        data = read_token(self.secret, token)
+
+        self.assertTrue(is_signed(token))
+        self.assertEqual(data['account_id'], 42)
+        self.assertEqual(data['expires'], expires)
+        self.assertLessEqual(data['issued'], time.time() * 1000)
+        self.assertNotEqual(data['nonce'], read_token(self.secret, sign_token(self.secret, 42, expires))['nonce'])
+
+    def test_invalid_signature(self):
+        token = sign_token(self.secret, 42, int(time.time()) + 3600)
+        payload, signature = token.rsplit('.', 1)
+
+        self.assertIsNone(read_token('other secret', token))
+        self.assertIsNone(read_token(self.secret, '{0}.{1}'.format(payload.replace('.2a.', '.2b.', 1), signature)))
+        self.assertIsNone(read_token(self.secret, '{0}.{1}'.format(payload, signature[::-1])))
+
+    def test_empty_secret(self):
+        for secret in ('', None):
+            with self.assertRaises(ValueError):
+                sign_token(secret, 42, int(time.time()) + 3600)
+
+            # Signed with the empty key
+            payload = 's1.2a.1.{0:x}.abcdef'.format(int(time.time()) + 3600)
+            self.assertIsNone(read_token(secret, '{0}.{1}'.format(payload, _signature(b'', payload))))
+
+    def test_non_ascii(self):
+        token = sign_token(self.secret, 42, int(time.time()) + 3600)
+        self.assertIsNone(read_token(self.secret, token[0:-1] + 'é'))
+
+    def test_malformed(self):
+        for token in ('', 's1.', 's1.2a.zz.1.2.3', 'abcdef0123456789'):
+            self.assertIsNone(read_token(self.secret, token))
+
+        self.assertFalse(is_signed('abcdef0123456789'))
+
+    def test_expired(self):
+        self.assertIsNone(read_token(self.secret, sign_token(self.secret, 42, int(time.time()) - 1)))
+
+
+class RevocationTest(BaseTestCase):
+    __display__ = 'Token revocation'
+    secret = 'secret'
+
+    def _data(self, account_id=42):
+        return read_token(self.secret, sign_token(self.secret, account_id, int(time.time()) + 3600))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(bits=1 << 16)
+        bloom.add('t:abc')
+        self.assertIn('t:abc', bloom)
+        self.assertNotIn('t:abd', bloom)
+
+    def test_revoke_token(self):
+        revocations = LocalRevocationFilter()
+        data, other = self._data(), self._data()
+        revocations.revoke(data['nonce'])
+
+        self.assertTrue(revocations.is_revoked(data))
+        self.assertFalse(revocations.is_revoked(other))
+
+    def test_revoke_account(self):
+        revocations = LocalRevocationFilter()
+        before = self._data(42)
+        time.sleep(0.002)
+        revocations.revoke_account(42)
+        time.sleep(0.002)
+
+        self.assertTrue(revocations.is_revoked(before))
+        self.assertFalse(revocations.is_revoked(self._data(43)))
+        # Tokens issued after the revocation are valid
+        self.assertFalse(revocations.is_revoked(self._data(42)))
+
+    def test_fails_closed(self):
+        revocations = BrokenRevocationFilter()
+        data = self._data()
+        self.assertFalse(revocations.is_revoked(data))
+
+        revocations.filter.add('t:{0}'.format(data['nonce']))
+        self.assertTrue(revocations.is_revoked(data))
@@ -1,34 +1,51 @@
 # -*- coding:utf-8 -*-
 
 from flask import current_app
-import requests, hashlib, json, socket
+import hashlib, logging, socket, time, uuid
+
+# Events are sent from the server, the host stands for the device
+DEVICE_ID = hashlib.md5(socket.gethostname().encode()).hexdigest()
 
 
 def amplitude_track(event_type, properties=None):
+    """
+    Queues the event, it is sent in the background by app.amplitude (see send_amplitude_events)
+    """
     if current_app.config.get('AMPLITUDE_API_KEY') is None:
         current_app.logger.error('AMPLITUDE API KEY not defined')
         return None
 
     message = {
-        'device_id': hashlib.md5(socket.gethostbyname().encode()).hexdigest(),
-        'event_type': event_type
+        'device_id': DEVICE_ID,
+        'event_type': event_type,
+        'time': int(time.time() * 1000),
+        'insert_id': uuid.uuid4().hex  # Lets Amplitude deduplicate the events of a batch sent twice
     }
 
     if properties:
         message['event_properties'] = properties
 
-    try:
-        response = requests.post(
-            'https://api.amplitude.com/httpapi',
-            data={
-                'api_key': current_app.config.get('AMPLITUDE_API_KEY'),
-                'event': json.dumps(message)
-            },
-            timeout=3
-        )
-        response.raise_for_status()
-    except Exception:
-        current_app.logger.debug("[Amplitude]")
+    current_app.amplitude.submit(message)
+
+
+def send_amplitude_events(client, api_key, events):
+    """
+    Sends a batch of events. Rejected events are dropped, other failures raise so the batch is retried
+    """
+    response = client.post(
+        'amplitude',
+        'https://api2.amplitude.com/batch',
+        json={
+            'api_key': api_key,
+            'events': events
+        }
+    )
+
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        logging.error('[Amplitude] {0} events rejected: {1}'.format(len(events), response.text))
+        return None
+
+    response.raise_for_status()
 
 
 def twilio(to, message):
@@ -48,7 +65,8 @@ def twilio(to, message):
     }
 
     try:
-        r = requests.post(
+        r = current_app.http.post(
+            'twilio',
             'https://api.twilio.com/2010-04-01/Accounts/{0}/Messages.json'.format(current_app.config.get('TWILIO_AUTH_KEY')),
             auth=(current_app.config.get('TWILIO_AUTH_KEY'), current_app.config.get('TWILIO_AUTH_TOKEN')),
             data=params
@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+
+import datetime, json, zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Encoded items start with a header byte: 0x80 | version << 4 | serializer << 2 | compression
+JSON text never starts with a byte above 0x7F, so items without header are decoded as legacy JSON.
+"""
+
+VERSION = 1
+SERIALIZERS = {'json': 0, 'msgpack': 1}
+COMPRESSIONS = {None: 0, 'zlib': 1, 'zstd': 2}
+DATETIME_EXT = 1  # msgpack extension type of datetimes
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+
+    raise TypeError('Object of type {0} is not JSON serializable'.format(type(value).__name__))
+
+
+def _json_object_hook(value):
+    if len(value) == 1 and '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+
+    return value
+
+
+def _msgpack_default(value):
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(DATETIME_EXT, value.isoformat().encode('utf-8'))
+
+    raise TypeError('Object of type {0} is not serializable'.format(type(value).__name__))
+
+
+def _msgpack_ext_hook(code, data):
+    if code == DATETIME_EXT:
+        return datetime.datetime.fromisoformat(data.decode('utf-8'))
+
+    return msgpack.ExtType(code, data)
+
+
+class Codec(object):
+    """
+    Serializes queue items with msgpack (JSON when it isn't installed), compressed with zstd
+    (zlib when it isn't installed) when larger than `threshold` bytes.
+    Datetimes are supported by both serializers. Any item encoded by a Codec, whatever its
+    settings, and plain JSON items can be decoded.
+    """
+    def __init__(self, serializer='msgpack', compression='zstd', threshold=1024, level=3):
+        if serializer == 'msgpack' and msgpack is None:
+            serializer = 'json'
+
+        if compression == 'zstd' and zstandard is None:
+            compression = 'zlib'
+
+        if serializer not in SERIALIZERS or compression not in COMPRESSIONS:
+            raise ValueError('Unknown serializer or compression: {0}, {1}'.format(serializer, compression))
+
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, item):
+        if self.serializer == 'msgpack':
+            data = msgpack.packb(item, default=_msgpack_default, use_bin_type=True)
+        else:
+            data = json.dumps(item, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+        compression = self.compression if len(data) > self.threshold else None
+        if compression == 'zlib':
+            data = zlib.compress(data, self.level)
+        elif compression == 'zstd':
+            data = zstandard.ZstdCompressor(level=self.level).compress(data)
+
+        header = 0x80 | VERSION << 4 | SERIALIZERS[self.serializer] << 2 | COMPRESSIONS[compression]
+        return bytes([header]) + data
+
+    def decode(self, raw):
+        """Raises ValueError when the item can't be decoded"""
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+
+        if not raw or raw[0] < 0x80:
+            return json.loads(raw, object_hook=_json_object_hook)
+
+        header, data = raw[0], raw[1:]
+        if (header >> 4) & 0x7 != VERSION:
+            raise ValueError('Unsupported codec version {0}'.format((header >> 4) & 0x7))
+
+        try:
+            compression = header & 0x3
+            if compression == COMPRESSIONS['zlib']:
+                data = zlib.decompress(data)
+            elif compression == COMPRESSIONS['zstd']:
+                if zstandard is None:
+                    raise ValueError('zstandard is required to decode this item')
+                data = zstandard.ZstdDecompressor().decompress(data)
+
+            if (header >> 2) & 0x3 == SERIALIZERS['msgpack']:
+                if msgpack is None:
+                    raise ValueError('msgpack is required to decode this item')
+                # Maps may have int keys (json.dumps turned them into str, msgpack keeps them)
+                return msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, raw=False, strict_map_key=False)
+
+            return json.loads(data, object_hook=_json_object_hook)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(str(e))
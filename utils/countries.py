@@ -1,8 +1,10 @@
 # -*- coding:utf-8 -*-
 
-from xml.etree import ElementTree
+from flask import current_app
+from xml.etree.ElementTree import XMLPullParser
 from sentry_sdk import capture_exception
-import requests
+from utils.cache import LRUCache, SingleFlight
+import json, time
 
 countries = (
     ('AF', 'Afghanistan'),
@@ -292,24 +294,101 @@ def get_country_name(code):
             return country[1]
 
 
+VIES_BODY = "<s11:Envelope xmlns:s11='http://schemas.xmlsoap.org/soap/envelope/'><s11:Body><tns1:checkVat xmlns:tns1='urn:ec.europa.eu:taxud:vies:services:checkVat:types'><tns1:countryCode>{}</tns1:countryCode><tns1:vatNumber>{}</tns1:vatNumber></tns1:checkVat></s11:Body></s11:Envelope>"
+VIES_TYPES = '{urn:ec.europa.eu:taxud:vies:services:checkVat:types}'
+VIES_FIELDS = {VIES_TYPES + field: field for field in ('valid', 'countryCode', 'name', 'address')}
+
+_vies_local = LRUCache(4096)
+_vies_flight = SingleFlight()
+
+
 def get_vat_details(vat_number):
-    body = "<s11:Envelope xmlns:s11='http://schemas.xmlsoap.org/soap/envelope/'><s11:Body><tns1:checkVat xmlns:tns1='urn:ec.europa.eu:taxud:vies:services:checkVat:types'><tns1:countryCode>{}</tns1:countryCode><tns1:vatNumber>{}</tns1:vatNumber></tns1:checkVat></s11:Body></s11:Envelope>"
+    """
+    Checks the VAT number against VIES. Answers are cached in the process and in Redis,
+    valid ones for VIES_CACHE_TTL and invalid ones for VIES_CACHE_NEGATIVE_TTL seconds.
+    When VIES can't be reached, the last known answer is returned (up to VIES_CACHE_STALE_TTL).
+    """
+    key = vat_number.replace(' ', '').upper()
+    entry = _vies_cache_get(key)
+    if entry is not None:
+        ttl = current_app.config.get('VIES_CACHE_TTL' if entry['details']['valid'] else 'VIES_CACHE_NEGATIVE_TTL')
+        if time.time() - entry['checked'] < ttl:
+            return entry['details']
+
+    try:
+        return _vies_flight.do(key, _vies_refresh, key)
+    except ValueError:
+        if entry is None:
+            raise
+
+        current_app.logger.warning('VIES unavailable, using the answer from {0:.0f}s ago for {1}'.format(time.time() - entry['checked'], key))
+        return entry['details']
+
+
+def _vies_refresh(vat_number):
+    details = _vies_check(vat_number)
+    entry = {'details': details, 'checked': time.time()}
+    lifetime = current_app.config.get('VIES_CACHE_STALE_TTL')
+
+    _vies_local.set(vat_number, entry, lifetime)
+    if hasattr(current_app, 'redis_queue'):
+        try:
+            current_app.redis_queue.connection().set(_vies_key(vat_number), json.dumps(entry), ex=lifetime)
+        except Exception:
+            current_app.logger.exception('[VIES] Unable to write to Redis')
+
+    return details
+
+
+def _vies_cache_get(vat_number):
+    entry = _vies_local.get(vat_number)
+    if entry is not None or not hasattr(current_app, 'redis_queue'):
+        return entry
 
     try:
-        r = requests.post(
+        cached = current_app.redis_queue.connection().get(_vies_key(vat_number))
+    except Exception:
+        current_app.logger.exception('[VIES] Unable to read from Redis')
+        return None
+
+    if cached is None:
+        return None
+
+    entry = json.loads(cached)
+    _vies_local.set(vat_number, entry, current_app.config.get('VIES_CACHE_STALE_TTL'))
+    return entry
+
+
+def _vies_key(vat_number):
+    return '{0}:vies:{1}'.format(current_app.redis_queue.namespace, vat_number)
+
+
+def _vies_check(vat_number):
+    try:
+        # The streamed response holds its connection until closed
+        with current_app.http.post(
+            'vies',
             'http://ec.europa.eu/taxation_customs/vies/services/checkVatService',
             headers={'content-type': 'text/xml; charset= utf-8; SOAPAction: checkVatService'},
-            data=body.format(vat_number[0:2], vat_number[2:]),
-            timeout=10
-        )
-        r.raise_for_status()
-        tree = ElementTree.fromstring(r.content.decode())
-        return {
-            'valid': tree[0][0].find('{urn:ec.europa.eu:taxud:vies:services:checkVat:types}valid').text == 'true',
-            'countryCode': tree[0][0].find('{urn:ec.europa.eu:taxud:vies:services:checkVat:types}countryCode').text,
-            'name': tree[0][0].find('{urn:ec.europa.eu:taxud:vies:services:checkVat:types}name').text,
-            'address': tree[0][0].find('{urn:ec.europa.eu:taxud:vies:services:checkVat:types}address').text
-        }
+            data=VIES_BODY.format(vat_number[0:2], vat_number[2:]),
+            stream=True
+        ) as r:
+            r.raise_for_status()
+
+            # Only the fields we need are kept, elements are dropped as soon as they are read
+            details = {}
+            parser = XMLPullParser(events=('end',))
+            for chunk in r.iter_content(4096):
+                parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if element.tag in VIES_FIELDS:
+                        details[VIES_FIELDS[element.tag]] = element.text
+                    element.clear()
+
+            parser.close()
+
+        details['valid'] = details['valid'] == 'true'
+        return details
     except Exception as e:
-        capture_exception('VIES failure')
+        capture_exception(e)
         raise ValueError('Unable to validate your VAT Number.')
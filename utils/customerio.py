@@ -1,45 +1,184 @@
 # -*- coding:utf-8 -*-
 
+from concurrent.futures import wait
 from flask import current_app
 from sentry_sdk import capture_exception
-import requests
+import json, time
 
 
 class CustomerIO(object):
+    """
+    Calls are queued in Redis by the outbox (see CustomerIOOutbox) and sent by the
+    `customerio_outbox` command, never from the request. Without outbox, they are ignored.
+    """
     @classmethod
-    def _request(cls, method, url, data=None, silent=False):
+    def _call(cls, method, url, data=None, version='v1'):
+        """Sends the request, raising on errors"""
         if current_app.debug:
             print("Sending {0} request to {1} with {2}".format(method, url, data))
 
         if not current_app.config.get('CUSTOMERIO_API_KEY', None):
             return None
 
-        r = getattr(requests, method)(
-            'https://track.customer.io/api/v1{0}'.format(url),
+        r = current_app.http.request(
+            'customerio',
+            method,
+            'https://track.customer.io/api/{0}{1}'.format(version, url),
             auth=(current_app.config.get('CUSTOMERIO_SITE_ID'), current_app.config.get('CUSTOMERIO_API_KEY')),
-            json=data,
-            timeout=3
+            json=data
         )
 
-        try:
-            r.raise_for_status()
-            return r
-        except Exception as e:
-            if not silent:
-                capture_exception(e)
+        r.raise_for_status()
+        return r
+
+    @classmethod
+    def _outbox(cls):
+        return getattr(current_app, 'customerio_outbox', None)
 
     @classmethod
     def account(cls, account_id, params):
-        return cls._request('put', '/customers/{0}'.format(account_id), params)
+        outbox = cls._outbox()
+        if outbox is not None:
+            outbox.account(account_id, params)
 
     @classmethod
     def event(cls, account_id, name, params=None):
-        event = {'name': name, 'data': {}}
-        if params:
-            event['data'] = params
-
-        return cls._request('post', '/customers/{0}/events'.format(account_id), event)
+        outbox = cls._outbox()
+        if outbox is not None:
+            outbox.event(account_id, name, params)
 
     @classmethod
     def remove(cls, account_id):
-        return cls._request('post', '/customers/{0}/suppress'.format(account_id))
+        outbox = cls._outbox()
+        if outbox is not None:
+            outbox.remove(account_id)
+
+
+# Claims the accounts due for an update: returns [id, [field, value, ...], ...]
+CLAIM_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local result = {}
+for _, id in ipairs(ids) do
+    local key = ARGV[3] .. id
+    redis.call('ZREM', KEYS[1], id)
+    table.insert(result, id)
+    table.insert(result, redis.call('HGETALL', key))
+    redis.call('DEL', key)
+end
+return result
+"""
+
+
+class CustomerIOOutbox(object):
+    """
+    CustomerIO calls waiting in Redis to be sent by the `customerio_outbox` command.
+
+    Account updates are merged per customer in a hash (the latest value of each attribute wins)
+    and sent as a single PUT `window` seconds after the first pending update.
+    Events and suppressions go to a list, sent by batches through the v2 batch endpoint.
+    Failed calls are queued again, up to `attempts` times.
+    """
+    def __init__(self, connection, namespace, window=30, attempts=5, retry_delay=60):
+        self.connection = connection
+        self.window = window
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.prefix = '{0}:customerio:account:'.format(namespace)
+        self.pending = '{0}:customerio:pending'.format(namespace)
+        self.actions = '{0}:customerio:actions'.format(namespace)
+        self.retries = '{0}:customerio:retries'.format(namespace)
+        self.claim = connection.register_script(CLAIM_SCRIPT)
+
+    def account(self, account_id, params):
+        self._merge(account_id, {key: json.dumps(value) for key, value in params.items()}, time.time() + self.window)
+
+    def event(self, account_id, name, params=None):
+        self._push([{
+            'type': 'person',
+            'identifiers': {'id': str(account_id)},
+            'action': 'event',
+            'name': name,
+            'attributes': params or {},
+            'timestamp': int(time.time())
+        }])
+
+    def remove(self, account_id):
+        # Pending updates would re-create the customer
+        p = self.connection.pipeline()
+        p.zrem(self.pending, account_id)
+        p.delete(self.prefix + str(account_id))
+        p.hdel(self.retries, account_id)
+        p.rpush(self.actions, json.dumps({'type': 'person', 'identifiers': {'id': str(account_id)}, 'action': 'suppress'}))
+        p.execute()
+
+    def drain(self, executor, accounts=100, batch_size=100):
+        """
+        Sends the accounts due and up to `batch_size` actions using the given executor,
+        and waits for them to complete. Returns the number of calls made.
+        """
+        app = current_app._get_current_object()
+        claimed = self.claim(keys=[self.pending], args=[time.time(), accounts, self.prefix])
+        futures = []
+        for i in range(0, len(claimed), 2):
+            account_id = claimed[i].decode('utf-8')
+            fields = claimed[i + 1]
+            params = {fields[j].decode('utf-8'): json.loads(fields[j + 1]) for j in range(0, len(fields), 2)}
+            futures.append(executor.submit(self._run, app, self._send_account, account_id, params))
+
+        p = self.connection.pipeline()
+        p.lrange(self.actions, 0, batch_size - 1)
+        p.ltrim(self.actions, batch_size, -1)
+        actions = [json.loads(action) for action in p.execute()[0]]
+        if actions:
+            futures.append(executor.submit(self._run, app, self._send_actions, actions))
+
+        wait(futures)
+        return len(futures)
+
+    def _run(self, app, method, *args):
+        with app.app_context():
+            method(*args)
+
+    def _send_account(self, account_id, params):
+        try:
+            CustomerIO._call('put', '/customers/{0}'.format(account_id), params)
+            self.connection.hdel(self.retries, account_id)
+        except Exception as e:
+            if self.connection.hincrby(self.retries, account_id) >= self.attempts:
+                capture_exception(e)
+                self.connection.hdel(self.retries, account_id)
+                return None
+
+            # Newer updates made in the meantime take precedence
+            self._merge(account_id, {key: json.dumps(value) for key, value in params.items()}, time.time() + self.retry_delay, overwrite=False)
+
+    def _send_actions(self, actions):
+        try:
+            CustomerIO._call('post', '/batch', {'batch': [{key: value for key, value in action.items() if key != 'attempts'} for action in actions]}, 'v2')
+        except Exception as e:
+            retry = []
+            for action in actions:
+                action['attempts'] = action.get('attempts', 0) + 1
+                if action['attempts'] < self.attempts:
+                    retry.append(action)
+
+            if len(retry) < len(actions):
+                capture_exception(e)
+
+            if retry:
+                self._push(retry)
+
+    def _merge(self, account_id, fields, due, overwrite=True):
+        key = self.prefix + str(account_id)
+        p = self.connection.pipeline()
+        if overwrite:
+            p.hset(key, mapping=fields)
+        else:
+            for field, value in fields.items():
+                p.hsetnx(key, field, value)
+
+        p.zadd(self.pending, {account_id: due}, nx=True)
+        p.execute()
+
+    def _push(self, actions):
+        self.connection.rpush(self.actions, *[json.dumps(action) for action in actions])
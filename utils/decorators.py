@@ -4,7 +4,10 @@ from flask import current_app, make_response, abort, jsonify, request, g
 import time, functools, base64
 
 
-def authenticated(func=None, level='bearer', limit=5):
+def authenticated(func=None, level='bearer', limit=5, account_limit=None):
+    """
+    limit: requests per minute per IP, account_limit: per account (RATELIMIT_ACCOUNT by default)
+    """
     assert level in ('bearer', 'api')
 
     def _authenticated(view_func):
@@ -21,10 +24,9 @@ def authenticated(func=None, level='bearer', limit=5):
                     Authorization: Bearer XXXXXXXX
                     Is for access from the web application
                     """
-                    from auth.models import Session
-                    session = Session.find_by_token(auth[7:])
-                    assert session is not None
-                    g.account = session.account
+                    account = current_app.token_resolver.resolve_session(auth[7:])
+                    assert account is not None
+                    g.account = account
                 elif auth[0:5].lower() == 'basic':
                     """
                     Authorization: Basic sk_xxxxxx
@@ -45,30 +47,25 @@ def authenticated(func=None, level='bearer', limit=5):
                         passwd = credentials.split(':')[1]  # Authorization : api:sk_xxxxx
                         assert passwd[0:2] == 'sk'
 
-                    from accounts.models import ApiKey
-                    account = ApiKey.account_by_token(passwd)
+                    account = current_app.token_resolver.resolve_api_key(passwd)
                     assert account is not None
                     g.account = account
             except AssertionError as e:
                 print(e)
                 abort(401)
 
-            remote_addr = request.remote_addr
-            if request.headers.getlist("X-Forwarded-For"):
-                remote_addr = request.headers.getlist("X-Forwarded-For")[0]
-
-            key = 'rate-limit/{0}/{1}'.format(remote_addr, request.endpoint)
-            ratelimit = RateLimit(key, limit)
-            g._view_rate_limit = ratelimit
-            if ratelimit.over_limit:
-                return make_response(jsonify({
-                    'success': False,
-                    'error': 'You have been rate limited. Please wait {0} seconds.'.format(ratelimit.reset - int(time.time())),
-                    'code': 429
-                }), 429)
+            response = check_rate_limit([
+                ('rate-limit/{0}/{1}'.format(get_remote_addr(), request.endpoint), limit),
+                ('rate-limit/account/{0}/{1}'.format(g.account.id, request.endpoint), account_limit or current_app.config.get('RATELIMIT_ACCOUNT'))
+            ])
+            if response is not None:
+                return response
 
-            if auth[0:5].lower() != 'basic' and g.get('_ga') is not None:
-                g._ga.set_uid(g.account.uuid)
+            if auth[0:5].lower() != 'basic':
+                # Used by the tracker if the request ends up building one
+                g._ga_uid = g.account.uuid
+                if g.get('_ga') is not None:
+                    g._ga.set_uid(g.account.uuid)
 
             return view_func(*args, **kwargs)
 
@@ -84,19 +81,11 @@ def ratelimit(func=None, limit=5):
     def _ratelimit(view_func):
         @functools.wraps(view_func)
         def wrapper(*args, **kwargs):
-            remote_addr = request.remote_addr
-            if request.headers.getlist("X-Forwarded-For"):
-                remote_addr = request.headers.getlist("X-Forwarded-For")[0]
-
-            key = 'rate-limit/{0}/{1}'.format(remote_addr, request.endpoint)
-            ratelimit = RateLimit(key, limit)
-            g._view_rate_limit = ratelimit
-            if ratelimit.over_limit:
-                return make_response(jsonify({
-                    'success': False,
-                    'error': 'You have been rate limited. Please wait {0} seconds.'.format(ratelimit.reset - int(time.time())),
-                    'code': 429
-                }), 429)
+            response = check_rate_limit([
+                ('rate-limit/{0}/{1}'.format(get_remote_addr(), request.endpoint), limit)
+            ])
+            if response is not None:
+                return response
 
             return view_func(*args, **kwargs)
 
@@ -108,23 +97,43 @@ def ratelimit(func=None, limit=5):
     return _ratelimit
 
 
-class RateLimit(object):
-    expiration_window = 10
-
-    def __init__(self, key_prefix, limit):
-        """
-        limit: int - Number of request per minutes
-        """
-        self.reset = (int(time.time()) // 60) * 60 + 60
-        self.key = key_prefix + str(self.reset)
-        self.limit = limit + 1
-        if hasattr(current_app, 'redis_queue'):
-            p = current_app.redis_queue.pipeline()
-            p.incr(self.key)
-            p.expireat(self.key, self.reset + self.expiration_window)
-            self.current = min(p.execute()[0], self.limit)
-        else:
-            self.current = 0
-
-    remaining = property(lambda x: x.limit - x.current)
-    over_limit = property(lambda x: x.current >= x.limit)
+def get_remote_addr(req=None):
+    """
+    req defaults to the current Flask request
+    """
+    req = req or request
+    remote_addr = req.remote_addr
+    if req.headers.getlist("X-Forwarded-For"):
+        remote_addr = req.headers.getlist("X-Forwarded-For")[0]
+
+    return remote_addr
+
+
+def check_rate_limit(rules):
+    """
+    Checks all the (key, limit) rules at once (limit being per minute)
+    Returns a 429 response when one of them is over limit, None otherwise.
+    When the limiter fails, requests are let through if RATELIMIT_FAIL_OPEN, answered with a 503 otherwise
+    """
+    try:
+        ratelimit = current_app.rate_limiter.check(rules)
+    except Exception:
+        current_app.logger.exception('Rate limiter unavailable, failing {0}'.format('open' if current_app.config.get('RATELIMIT_FAIL_OPEN') else 'closed'))
+        if current_app.config.get('RATELIMIT_FAIL_OPEN'):
+            return None
+
+        return make_response(jsonify({
+            'success': False,
+            'error': 'Service unavailable. Please try again.',
+            'code': 503
+        }), 503)
+
+    g._view_rate_limit = ratelimit
+    if ratelimit.over_limit:
+        return make_response(jsonify({
+            'success': False,
+            'error': 'You have been rate limited. Please wait {0} seconds.'.format(max(ratelimit.reset - int(time.time()), 1)),
+            'code': 429
+        }), 429)
+
+    return None
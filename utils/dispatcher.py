@@ -0,0 +1,213 @@
+# -*- coding:utf-8 -*-
+
+import atexit, fcntl, json, logging, os, queue, threading, time
+
+
+def _parse(lines, spool):
+    """Decodes the spooled items, skipping (and logging) the corrupt ones"""
+    items = []
+    for line in lines:
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            logging.warning('Skipping a corrupt item of {0}: {1!r}'.format(spool, line[0:100]))
+
+    return items
+
+
+class DiskSpool(object):
+    """Items kept on disk, one JSON document per line, shared by the processes using the same file"""
+    def __init__(self, path):
+        self.path = path
+
+    def push(self, items):
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(''.join(json.dumps(item) + '\n' for item in items))
+
+    def pop(self, count):
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lines = f.readlines()
+            items = _parse(lines[0:count], self.path)
+            f.seek(0)
+            f.truncate()
+            f.writelines(lines[count:])
+
+        return items
+
+
+class RedisSpool(object):
+    """Items kept in a Redis list"""
+    def __init__(self, connection, key):
+        self.connection = connection
+        self.key = key
+
+    def push(self, items):
+        self.connection.rpush(self.key, *[json.dumps(item) for item in items])
+
+    def pop(self, count):
+        p = self.connection.pipeline()
+        p.lrange(self.key, 0, count - 1)
+        p.ltrim(self.key, count, -1)
+        return _parse(p.execute()[0], self.key)
+
+
+class BatchDispatcher(object):
+    """
+    Buffers items in a bounded in-process queue, drained by a background thread that
+    hands them to `send_batch(items)` by groups of up to `batch_size`. Once it has an item,
+    the thread waits up to `linger` seconds for the batch to fill up.
+
+    When the queue is full, items go to the `spool` (see DiskSpool and RedisSpool) if set,
+    or are dropped. With `retry_failed`, batches for which send_batch raised go to the spool too,
+    each item up to `max_attempts` times, then it's dropped.
+    Spooled items are sent again when the queue is idle, at most every `replay_interval` seconds.
+    The queue is flushed when the process exits.
+    """
+    def __init__(self, name, send_batch, batch_size=20, maxsize=10000, linger=0, spool=None, retry_failed=False, replay_interval=10, max_attempts=5):
+        self.name = name
+        self.send_batch = send_batch
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self.linger = linger
+        self.spool = spool
+        self.retry_failed = retry_failed
+        self.replay_interval = replay_interval
+        self.max_attempts = max_attempts
+        self.counters = {'queued': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'spooled': 0, 'batches': 0, 'latency': 0.0}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._stop = None
+        self._thread = None
+        self._replayed = 0
+
+    def submit(self, item):
+        """Never blocks"""
+        self._start()
+        try:
+            self._queue.put_nowait((0, item))  # (failed attempts, item)
+            self._count('queued')
+        except queue.Full:
+            if not self._spool([item]):
+                self._count('dropped')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+
+        stats['pending'] = self._queue.qsize() if self._queue is not None else 0
+        stats['latency_avg'] = stats['latency'] / stats['batches'] if stats['batches'] else 0
+        return stats
+
+    def flush(self, timeout=5):
+        """Stops the thread once everything queued has been sent (or timeout is reached)"""
+        if self._thread is None or self._pid != os.getpid():
+            return None
+
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _start(self):
+        # Threads don't survive a fork, each worker process starts its own
+        if self._pid == os.getpid():
+            return None
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.maxsize)
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, name='dispatcher-{0}'.format(self.name), daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                self._replay()
+                continue
+
+            deadline = time.time() + self.linger
+            while len(batch) < self.batch_size:
+                wait = deadline - time.time()
+                try:
+                    if wait > 0 and not self._stop.is_set():
+                        batch.append(self._queue.get(timeout=wait))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._send(batch)
+
+    def _send(self, batch):
+        started = time.time()
+        try:
+            self.send_batch([item for attempts, item in batch])
+            self._count('sent', len(batch))
+        except Exception:
+            logging.exception('[{0}] Unable to send {1} items'.format(self.name, len(batch)))
+            self._count('failed', len(batch))
+            if self.retry_failed:
+                retry = [{'__attempts__': attempts + 1, '__item__': item} for attempts, item in batch if attempts + 1 < self.max_attempts]
+                if len(retry) < len(batch):
+                    logging.error('[{0}] {1} items dropped after {2} attempts'.format(self.name, len(batch) - len(retry), self.max_attempts))
+                    self._count('dropped', len(batch) - len(retry))
+
+                if retry and not self._spool(retry):
+                    logging.warning('[{0}] {1} failed items dropped, they can\'t be spooled'.format(self.name, len(retry)))
+                    self._count('dropped', len(retry))
+        finally:
+            self._count('batches')
+            self._count('latency', time.time() - started)
+
+    def _spool(self, items):
+        if self.spool is None:
+            return False
+
+        try:
+            self.spool.push(items)
+            self._count('spooled', len(items))
+            return True
+        except Exception:
+            logging.exception('[{0}] Unable to spool {1} items'.format(self.name, len(items)))
+            return False
+
+    def _replay(self):
+        if self.spool is None or time.time() - self._replayed < self.replay_interval:
+            return None
+
+        self._replayed = time.time()
+        room = self.maxsize - self._queue.qsize()
+        if room <= 0:
+            return None
+
+        try:
+            items = self.spool.pop(room)
+        except Exception:
+            logging.exception('[{0}] Unable to read the spool'.format(self.name))
+            return None
+
+        for item in items:
+            try:
+                self._queue.put_nowait(self._unwrap(item))
+            except queue.Full:
+                self._spool([item])
+
+    def _unwrap(self, item):
+        """Spooled items are either submitted ones (overflow) or wrapped with their attempts (failed)"""
+        if isinstance(item, dict) and set(item) == {'__attempts__', '__item__'}:
+            return item['__attempts__'], item['__item__']
+
+        return 0, item
+
+    def _count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
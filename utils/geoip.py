@@ -0,0 +1,217 @@
+# -*- coding:utf-8 -*-
+
+from bisect import bisect_right
+import csv, ipaddress, logging, mmap, os, struct, threading, time
+
+"""
+Index file layout (little-endian):
+    magic (8 bytes), number of IPv4 entries (uint32), number of IPv6 entries (uint32)
+    IPv4 range starts (uint32 each, sorted), then their country codes (2 bytes each)
+    IPv6 range starts (16 bytes big-endian each, sorted), then their country codes (2 bytes each)
+Gaps between ranges are stored as entries with an empty country code.
+"""
+
+MAGIC = b'GEOIDX1\0'
+HEADER = struct.Struct('<8sII')
+UNKNOWN = b'\0\0'
+
+
+def _parse_address(value):
+    value = value.strip().strip('"')
+    if value.isdigit():
+        return ipaddress.ip_address(int(value))
+
+    return ipaddress.ip_address(value)
+
+
+def _flatten(ranges, last):
+    """
+    Converts sorted (start, end, code) ranges to starts and codes, filling the gaps
+    """
+    starts, codes = [], []
+    previous_end = None
+    for start, end, code in sorted(ranges):
+        if previous_end is not None and start > previous_end + 1:
+            starts.append(previous_end + 1)
+            codes.append(UNKNOWN)
+
+        starts.append(start)
+        codes.append(code)
+        previous_end = end
+
+    if previous_end is not None and previous_end < last:
+        starts.append(previous_end + 1)
+        codes.append(UNKNOWN)
+
+    return starts, codes
+
+
+def build_index(source, destination):
+    """
+    Builds the index from a CSV file of "start ip,end ip,country code" rows
+    (ips either as strings or integers, as in the DB-IP and IP2Location lite databases)
+    Returns the number of IPv4 and IPv6 entries written.
+    """
+    v4, v6 = [], []
+    with open(source, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 3:
+                continue
+
+            try:
+                start, end = _parse_address(row[0]), _parse_address(row[1])
+            except ValueError:
+                continue  # Header or comment
+
+            code = row[2].strip().upper().encode('ascii', errors='ignore')
+            if len(code) != 2 or code in (b'--', b'ZZ'):
+                code = UNKNOWN
+
+            (v4 if start.version == 4 else v6).append((int(start), int(end), code))
+
+    v4_starts, v4_codes = _flatten(v4, 2 ** 32 - 1)
+    v6_starts, v6_codes = _flatten(v6, 2 ** 128 - 1)
+
+    # Written next to the destination then moved, so running processes keep a consistent file
+    temporary = '{0}.{1}.tmp'.format(destination, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(v4_starts), len(v6_starts)))
+        f.write(struct.pack('<{0}I'.format(len(v4_starts)), *v4_starts))
+        f.write(b''.join(v4_codes))
+        f.write(b''.join(start.to_bytes(16, 'big') for start in v6_starts))
+        f.write(b''.join(v6_codes))
+
+    os.replace(temporary, destination)
+    return len(v4_starts), len(v6_starts)
+
+
+class _Integers(object):
+    """Sequence of the little-endian uint32 IPv4 starts, for bisect"""
+    item = struct.Struct('<I')
+
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.item.unpack_from(self.buffer, self.offset + index * 4)[0]
+
+
+class _Addresses(object):
+    """Sequence of the 16 bytes IPv6 starts, for bisect"""
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = self.offset + index * 16
+        return self.buffer[start:start + 16]
+
+
+class GeoIP(object):
+    """
+    Offline IP to country lookups, on an index built by the `geoip` command.
+    The index is memory mapped read-only, so its pages are shared by every process of the host.
+    The file is checked for changes every `check_interval` seconds.
+    """
+    def __init__(self, path, check_interval=60):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._index = None
+        self._mtime = None
+        self._checked = 0
+
+    def lookup(self, address):
+        """
+        Returns the country code of the address (IPv4 or IPv6), None when unknown
+        """
+        index = self._load()
+        if index is None or not address:
+            return None
+
+        try:
+            ip = ipaddress.ip_address(address.split(',')[0].strip())
+        except ValueError:
+            return None
+
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+
+        if ip.version == 4:
+            starts, codes = index['v4']
+            position = bisect_right(starts, int(ip)) - 1
+        else:
+            starts, codes = index['v6']
+            position = bisect_right(starts, ip.packed) - 1
+
+        if position < 0:
+            return None
+
+        code = codes[position * 2:position * 2 + 2].tobytes()
+        if code == UNKNOWN:
+            return None
+
+        return code.decode('ascii')
+
+    def _load(self):
+        if time.time() - self._checked < self.check_interval:
+            return self._index
+
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                if self._index is None:
+                    logging.warning('GeoIP index not found at {0}, build it with the geoip command.'.format(self.path))
+                mtime = self._mtime
+
+            if mtime != self._mtime:
+                self._index = self._open()
+                self._mtime = mtime
+
+            self._checked = time.time()
+
+        return self._index
+
+    def _open(self):
+        """Returns None when the index can't be read (empty, truncated...), lookups finding nothing then"""
+        try:
+            with open(self.path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            magic, v4_count, v6_count = HEADER.unpack_from(buffer, 0)
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning('Unable to read the GeoIP index at {0}: {1}'.format(self.path, e))
+            return None
+
+        if magic != MAGIC:
+            logging.error('Invalid GeoIP index at {0}.'.format(self.path))
+            return None
+
+        if len(buffer) < HEADER.size + v4_count * 6 + v6_count * 18:
+            logging.warning('Truncated GeoIP index at {0}.'.format(self.path))
+            return None
+
+        view = memoryview(buffer)
+        offset = HEADER.size
+        v4_starts = _Integers(buffer, offset, v4_count)
+        offset += v4_count * 4
+        v4_codes = view[offset:offset + v4_count * 2]
+        offset += v4_count * 2
+        v6_starts = _Addresses(buffer, offset, v6_count)
+        offset += v6_count * 16
+        v6_codes = view[offset:offset + v6_count * 2]
+
+        return {
+            'v4': (v4_starts, v4_codes),
+            'v6': (v6_starts, v6_codes)
+        }
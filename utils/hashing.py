@@ -0,0 +1,179 @@
+# -*- coding:utf-8 -*-
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import HTTPException
+import bcrypt, os, threading, time
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+class HashingBusy(HTTPException):
+    code = 503
+    description = 'Too many authentication requests at the moment. Please try again.'
+
+
+class HostSemaphore(object):
+    """
+    Semaphore shared by every process of the host: slot i is a lock on the byte i of `path`.
+    Record locks belong to a process, not a thread, so the slots taken by the current process
+    are tracked too. Locks are released by the system when a process dies.
+    Without fcntl (non POSIX platforms), the slots are only shared by the threads of the process.
+    """
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._taken = set()
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+        try:
+            import fcntl  # noqa
+        except ImportError:
+            self.path = None
+
+    def acquire(self, timeout):
+        """Returns the slot taken, None when none was free within timeout seconds"""
+        deadline = time.monotonic() + timeout
+        while True:
+            slot = self._take()
+            if slot is not None or time.monotonic() >= deadline:
+                return slot
+
+            time.sleep(0.01)
+
+    def release(self, slot):
+        with self._lock:
+            if self.path is not None and self._pid == os.getpid():
+                import fcntl
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+
+            self._taken.discard(slot)
+
+    def _take(self):
+        with self._lock:
+            if self.path is not None and self._pid != os.getpid():
+                # Locks aren't inherited by forked processes
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                self._pid = os.getpid()
+                self._taken.clear()
+
+            for slot in range(self.slots):
+                if slot in self._taken:
+                    continue
+
+                if self.path is not None:
+                    import fcntl
+                    try:
+                        fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                    except OSError:
+                        continue
+
+                self._taken.add(slot)
+                return slot
+
+        return None
+
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt in a bounded process pool instead of the request thread.
+
+    At most `concurrency` hashes run at once on the host, whatever the number of worker
+    processes (see HostSemaphore). Any extra call waits up to `wait` seconds for a slot then
+    raises HashingBusy (503), so a login storm can't hold every worker of the node.
+    The pool of each worker process is started on the first hash, and again if one of its
+    processes died.
+
+    hash() and verify() wait for the result. The *_async methods return a
+    concurrent.futures.Future (see asyncio.wrap_future) and only wait for a slot.
+    """
+    def __init__(self, rounds=12, workers=1, concurrency=None, wait=5, lock_path=None):
+        self.rounds = rounds
+        self.workers = workers
+        self.wait = wait
+        self._slots = HostSemaphore(lock_path, concurrency or os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def hash_async(self, password):
+        return self._submit(_hashpw, password, self.rounds)
+
+    def hash(self, password):
+        return self._run(_hashpw, password, self.rounds)
+
+    def verify_async(self, password, hashed):
+        return self._submit(_checkpw, password, hashed)
+
+    def verify(self, password, hashed):
+        return self._run(_checkpw, password, hashed)
+
+    def needs_rehash(self, hashed):
+        """
+        bcrypt hashes look like $2b$12$..., 12 being the cost they were made with
+        """
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _run(self, func, *args):
+        try:
+            return self._submit(func, *args).result()
+        except BrokenProcessPool:
+            # A process of the pool died while hashing (OOM killer...), tried once more on a new pool
+            return self._submit(func, *args).result()
+
+    def _submit(self, func, *args):
+        slot = self._slots.acquire(self.wait)
+        if slot is None:
+            raise HashingBusy()
+
+        try:
+            if not self.workers:
+                future = Future()
+                future.set_result(func(*args))
+            else:
+                executor = self._get_executor()
+                try:
+                    future = executor.submit(func, *args)
+                except BrokenProcessPool:
+                    self._discard(executor)
+                    executor = self._get_executor()
+                    future = executor.submit(func, *args)
+
+                future.add_done_callback(lambda f: self._check(f, executor))
+        except Exception:
+            self._slots.release(slot)
+            raise
+
+        future.add_done_callback(lambda f: self._slots.release(slot))
+        return future
+
+    def _check(self, future, executor):
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._discard(executor)
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+        executor.shutdown(wait=False)
+
+    def _get_executor(self):
+        # The pool can't be shared with a forked process (preloaded app), we start a new one per pid
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+
+            return self._executor
@@ -0,0 +1,237 @@
+# -*- coding:utf-8 -*-
+
+from collections import deque
+from requests.adapters import HTTPAdapter
+import bisect, math, os, requests, threading, time
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised without making the request while the circuit of the provider is open"""
+
+
+class CircuitBreaker(object):
+    """
+    Per process state of a provider.
+
+    The circuit opens after `failures` consecutive errors or latency breaches (a response slower
+    than the current read timeout). While open, requests fail immediately; after `reset_timeout`
+    seconds a single probe is let through (half-open) and its outcome closes or re-opens the circuit.
+
+    The read timeout is derived from the p99 of the last `window` successful requests
+    (p99 * `multiplier`), bounded by `minimum` and the configured timeout.
+    Successes without latency (None) close the circuit without being sampled.
+    """
+    def __init__(self, failures=5, reset_timeout=30, window=200, multiplier=2, minimum=1):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.multiplier = multiplier
+        self.minimum = minimum
+        self.state = 'closed'
+        self.consecutive = 0
+        self.opened = 0
+        self.trips = 0
+        self._probing = None  # Thread making the half-open probe
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+
+            if self.state == 'open' and time.time() - self.opened >= self.reset_timeout:
+                self.state = 'half-open'
+
+            if self.state == 'half-open' and self._probing is None:
+                self._probing = threading.get_ident()
+                return True
+
+            return False
+
+    def success(self, latency, read_timeout):
+        with self._lock:
+            if latency is not None:
+                self._latencies.append(latency)
+                if latency > read_timeout:
+                    self._failed()
+                    return None
+
+            self.state = 'closed'
+            self.consecutive = 0
+            self._probing = None
+
+    def failure(self):
+        with self._lock:
+            self._failed()
+
+    def release(self):
+        """Ends the probe of the current thread if it got no outcome, so another one can be made"""
+        with self._lock:
+            if self._probing == threading.get_ident():
+                self._probing = None
+
+    def read_timeout(self, maximum):
+        """Read timeout to use, `maximum` until there are enough samples"""
+        with self._lock:
+            if len(self._latencies) < 20:
+                return maximum
+
+            latencies = sorted(self._latencies)
+
+        p99 = latencies[int(math.ceil(len(latencies) * 0.99)) - 1]
+        return min(maximum, max(self.minimum, p99 * self.multiplier))
+
+    def _failed(self):
+        self.consecutive += 1
+        self._probing = None
+        if self.state == 'half-open' or self.consecutive >= self.failures:
+            if self.state != 'open':
+                self.trips += 1
+
+            self.state = 'open'
+            self.opened = time.time()
+
+
+class HttpClient(object):
+    """
+    Outbound HTTP calls of every integration (Mailgun, CustomerIO, VIES, ...), by provider name.
+
+    Each provider gets its own session, keeping up to `pool_size` keep-alive connections per host,
+    and its own (connect, read) timeouts from `timeouts` (falling back to timeouts['default']).
+    Latencies are recorded per provider in a histogram, along with the errors
+    (connection failures, timeouts and 5xx responses).
+
+    Each provider also has a CircuitBreaker (configured by `circuit`, see its arguments) which
+    shortens the read timeout from the observed latencies and fails fast when the provider is down.
+    Requests uploading a large (or unknown size) body, like attachments, get the configured read timeout
+    and their latency is left out of the breaker, the upload time being part of it.
+    """
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Seconds
+    large_body = 256 * 1024  # Bytes
+
+    def __init__(self, pool_size=10, timeouts=None, circuit=None):
+        self.pool_size = pool_size
+        self.timeouts = timeouts or {}
+        self.circuit = circuit or {}
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._metrics = {}
+        self._breakers = {}
+        self._pid = None
+
+    def get(self, provider, url, **kwargs):
+        return self.request(provider, 'get', url, **kwargs)
+
+    def post(self, provider, url, **kwargs):
+        return self.request(provider, 'post', url, **kwargs)
+
+    def put(self, provider, url, **kwargs):
+        return self.request(provider, 'put', url, **kwargs)
+
+    def request(self, provider, method, url, **kwargs):
+        breaker = self.breaker(provider)
+        if not breaker.allow():
+            self._record(provider, 0, True)
+            raise CircuitOpenError('Circuit open for {0}'.format(provider))
+
+        try:
+            large = self._is_large(kwargs)
+            kwargs.setdefault('timeout', self.timeout(provider, adaptive=not large))
+            session = self._session(provider)
+
+            started = time.time()
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                self._record(provider, time.time() - started, True)
+                breaker.failure()
+                raise
+
+            latency = time.time() - started
+            self._record(provider, latency, response.status_code >= 500)
+            if response.status_code >= 500:
+                breaker.failure()
+            else:
+                timeout = kwargs['timeout']
+                breaker.success(None if large else latency, timeout[1] if isinstance(timeout, tuple) else (timeout or float('inf')))
+
+            return response
+        finally:
+            # Any other exception would hold the half-open probe forever
+            breaker.release()
+
+    def timeout(self, provider, adaptive=True):
+        """(connect, read) timeouts, the read one adapted to the recent latencies of the provider"""
+        connect, read = self.timeouts.get(provider, self.timeouts.get('default', (3, 10)))
+        return connect, self.breaker(provider).read_timeout(read) if adaptive else read
+
+    def breaker(self, provider):
+        with self._lock:
+            if provider not in self._breakers:
+                self._breakers[provider] = CircuitBreaker(**self.circuit)
+
+            return self._breakers[provider]
+
+    def stats(self):
+        """
+        Returns, per provider: requests and errors count, total latency, the histogram
+        (number of requests under each bucket, the last one being for slower requests),
+        the circuit state and the timeouts in use
+        """
+        with self._lock:
+            stats = {provider: {
+                'requests': metrics['requests'],
+                'errors': metrics['errors'],
+                'latency': metrics['latency'],
+                'histogram': dict(zip([str(x) for x in self.buckets] + ['+Inf'], metrics['histogram']))
+            } for provider, metrics in self._metrics.items()}
+
+        for provider in stats:
+            breaker = self.breaker(provider)
+            stats[provider]['circuit'] = {
+                'state': breaker.state,
+                'consecutive_failures': breaker.consecutive,
+                'trips': breaker.trips
+            }
+            stats[provider]['timeout'] = self.timeout(provider)
+
+        return stats
+
+    def _is_large(self, kwargs):
+        if kwargs.get('files'):
+            return True
+
+        data = kwargs.get('data')
+        if data is None or isinstance(data, dict):
+            return False
+
+        # Streamed bodies (files, generators) have no length
+        return not hasattr(data, '__len__') or len(data) > self.large_body
+
+    def _session(self, provider):
+        with self._lock:
+            # Connections can't be shared with a forked process
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+
+            if provider not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[provider] = session
+
+            return self._sessions[provider]
+
+    def _record(self, provider, latency, error):
+        with self._lock:
+            if provider not in self._metrics:
+                self._metrics[provider] = {'requests': 0, 'errors': 0, 'latency': 0.0, 'histogram': [0] * (len(self.buckets) + 1)}
+
+            metrics = self._metrics[provider]
+            metrics['requests'] += 1
+            metrics['latency'] += latency
+            metrics['histogram'][bisect.bisect_left(self.buckets, latency)] += 1
+            if error:
+                metrics['errors'] += 1
@@ -1,7 +1,10 @@
 # -*- coding:utf-8 -*-
 
-from flask import current_app, render_template_string
-import mimetypes, requests, os, json
+from flask import current_app
+from html import escape as html_escape
+from utils.cache import LRUCache
+from utils.multipart import MultipartEncoder
+import itertools, mimetypes, requests, os, json, pathlib, threading, time
 
 mimetypes.init()
 
@@ -14,6 +17,111 @@ def guess_mimetype(name):
     return 'text/plain'
 
 
+class EmailTemplates(object):
+    """
+    Email templates of the application (templates/emails/<name>.txt and .html), read once per process.
+    Sources (templates, subjects, or text given directly to Mailgun) are compiled once and kept
+    in an LRU. With `auto_reload` (in debug), files are read again when they change.
+    """
+    def __init__(self, path, environment, auto_reload=False, maxsize=1024):
+        self.path = path
+        self.environment = environment
+        self.auto_reload = auto_reload
+        self.compiled = LRUCache(maxsize, 86400)
+        self.counters = {'compiled': 0, 'rendered': 0, 'render_time': 0.0}
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def load(self, name):
+        """Returns the text and html sources of the template, None when a file is missing"""
+        entry = self._sources.get(name)
+        if entry is None or (self.auto_reload and entry['mtimes'] != self._mtimes(name)):
+            entry = self._read(name)
+            self._sources[name] = entry
+
+        return entry['text'], entry['html']
+
+    def compile(self, source):
+        template = self.compiled.get(source)
+        if template is None:
+            template = self.environment.from_string(source)
+            self.compiled.set(source, template)
+            self._count('compiled')
+
+        return template
+
+    def render(self, source, context):
+        """Same as flask.render_template_string, on the compiled template"""
+        started = time.time()
+        context = dict(context)
+        current_app.update_template_context(context)
+        result = self.compile(source).render(context)
+
+        self._count('rendered')
+        self._count('render_time', time.time() - started)
+        return result
+
+    def check_outputs(self, source, names):
+        """
+        Raises ValueError when one of the given variables is used other than printed as is ({{ name }}):
+        in filters, conditions, loops, expressions...
+        """
+        from jinja2 import nodes
+        tree = self.environment.parse(source)
+        printed = set(id(node) for output in tree.find_all(nodes.Output) for node in output.nodes if isinstance(node, nodes.Name))
+        for node in tree.find_all(nodes.Name):
+            if node.name in names and id(node) not in printed:
+                raise ValueError('"{0}" can only be printed as is in this template (line {1}).'.format(node.name, node.lineno))
+
+    def precompile(self):
+        """Loads and compiles every template, returns their number"""
+        names = set()
+        for root, directories, files in os.walk(self.path):
+            for filename in files:
+                name, extension = os.path.splitext(os.path.relpath(os.path.join(root, filename), self.path))
+                if extension in ('.txt', '.html'):
+                    names.add(name)
+
+        for name in names:
+            for source in self.load(name):
+                if source is not None:
+                    self.compile(source)
+
+        return len(names)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+
+        stats['render_time_avg'] = stats['render_time'] / stats['rendered'] if stats['rendered'] else 0
+        return stats
+
+    def _read(self, name):
+        entry = {'mtimes': self._mtimes(name)}
+        for extension in ('txt', 'html'):
+            try:
+                with open(os.path.join(self.path, '{0}.{1}'.format(name, extension))) as f:
+                    entry[extension] = f.read()
+            except IOError:
+                entry[extension] = None
+
+        return entry
+
+    def _mtimes(self, name):
+        mtimes = []
+        for extension in ('txt', 'html'):
+            try:
+                mtimes.append(os.stat(os.path.join(self.path, '{0}.{1}'.format(name, extension))).st_mtime)
+            except OSError:
+                mtimes.append(None)
+
+        return mtimes
+
+    def _count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+
 class Mailgun(object):
     def __init__(self, subject, template=None, text=None, html=None):
         self.files = {}
@@ -38,21 +146,7 @@ class Mailgun(object):
 
         if template:
             # set html and text
-            path = os.path.join(current_app.root_path, current_app.template_folder, 'emails')
-
-            try:
-                txt_file = open(os.path.join(path, '{0}.txt'.format(template)))
-                self.data['text'] = txt_file.read()
-                txt_file.close()
-            except IOError:
-                self.data['text'] = None
-
-            try:
-                html_file = open(os.path.join(path, '{0}.html'.format(template)))
-                self.data['html'] = html_file.read()
-                html_file.close()
-            except IOError:
-                self.data['html'] = None
+            self.data['text'], self.data['html'] = current_app.email_templates.load(template)
 
         if text:
             self.data['text'] = text
@@ -76,13 +170,19 @@ class Mailgun(object):
     def set_reply_to(self, from_name, from_email):
         self.data['h:Reply-To'] = self._set_email(from_name, from_email)
 
-    def add_attachment(self, name, content, type=None):
+    def add_attachment(self, name, content=None, type=None, path=None):
         """
-        Add attachment with content as binary content of the opened file
+        Add an attachment, content being its binary (or text) content or a seekable file-like object,
+        or read from `path` (a str or pathlib.Path). Paths and files are only read while sending, by chunks.
         """
         if not type:
             type = guess_mimetype(name)
 
+        if path is not None:
+            content = pathlib.Path(path)
+        elif not isinstance(content, (bytes, bytearray, str, pathlib.PurePath)) and not (hasattr(content, 'seekable') and content.seekable()):
+            raise ValueError('Attachments must be bytes, str, a path or a seekable file.')
+
         #           attachment[0]
         self.files['attachment[' + str(len(self.files)) + ']'] = (name, content, type)
 
@@ -104,55 +204,145 @@ class Mailgun(object):
         )
 
     def send_to(self, name, email, substitution=None, send_at=None):
-        self.data['to'] = []
-        self.data['cc'] = []
-        self.data['bcc'] = []
-
-        self.data['to'].append(self._set_email(name, email))
+        # Rendered in a copy, so the same instance can send to several recipients
+        data = dict(self.data)
+        data['to'] = [self._set_email(name, email)]
+        data['cc'] = []
+        data['bcc'] = []
 
         if substitution is None:
             substitution = {}
 
         if substitution:
-            self.data['subject'] = render_template_string(self.data['subject'], **substitution)
-            substitution['subject'] = self.data['subject']
+            templates = current_app.email_templates
+            data['subject'] = templates.render(self.data['subject'], substitution)
+            substitution['subject'] = data['subject']
 
-            if self.data['text'] is not None:
-                self.data['text'] = render_template_string(self.data['text'], **substitution)
+            if data['text'] is not None:
+                data['text'] = templates.render(self.data['text'], substitution)
 
-            if self.data['html'] is not None:
-                self.data['html'] = render_template_string(self.data['html'], **substitution)
+            if data['html'] is not None:
+                data['html'] = templates.render(self.data['html'], substitution)
 
-        self._send(send_at)
+        return self._send(data, send_at)
 
-    def _send(self, send_at=None):
-        # We do some changes to data so we make a copy of it
+    def send_bulk(self, accounts, substitution=None, variables=None, send_at=None, chunk_size=1000):
+        """
+        Sends the email to every account of the iterable, by chunks of up to `chunk_size` recipients
+        per Mailgun request. The templates are rendered once: the values differing by recipient
+        (name, firstname, email and the keys returned by `variables(account)`, the same for every account)
+        are replaced by Mailgun using recipient-variables, HTML escaped ones in the html part.
+        Mailgun only substitutes them, so templates can print them as is but not filter or test them
+        (ValueError is raised otherwise).
+        Returns the number of recipients sent and failed.
+        """
+        accounts = iter(accounts)
+        data = None
+        sent, failed, chunk = 0, 0, 0
+
+        while True:
+            recipients = {}
+            for account in itertools.islice(accounts, chunk_size):
+                if not account.email:
+                    continue
+
+                values = {
+                    'name': str(account),
+                    'firstname': account.get_firstname() if hasattr(account, 'get_firstname') else str(account),
+                    'email': account.email
+                }
+                if variables is not None:
+                    values.update(variables(account))
+
+                if self.data['html'] is not None:
+                    # Mailgun doesn't escape anything
+                    values.update({'{0}__html'.format(key): html_escape(str(value)) for key, value in list(values.items())})
+
+                # Mailgun finds the variables by the bare address
+                recipients[account.email] = (self._set_email(str(account), account.email), values)
+
+            if not recipients:
+                break
+
+            if data is None:
+                keys = [key for key in next(iter(recipients.values()))[1].keys() if not key.endswith('__html')]
+                data = self._render_bulk(substitution, keys, send_at)
+
+            chunk += 1
+            data['to'] = [to for to, values in recipients.values()]
+            data['recipient-variables'] = json.dumps({email: values for email, (to, values) in recipients.items()})
+
+            started = time.time()
+            if self._post(data) is None and not self.is_mocked():
+                failed += len(recipients)
+            else:
+                sent += len(recipients)
+
+            elapsed = max(time.time() - started, 0.001)
+            current_app.logger.info('[Mailgun] Chunk {0}: {1} recipients in {2:.2f}s ({3:.0f}/sec), {4} sent so far'.format(
+                chunk, len(recipients), elapsed, len(recipients) / elapsed, sent
+            ))
+
+        return {'sent': sent, 'failed': failed}
+
+    def _render_bulk(self, substitution, keys, send_at):
+        templates = current_app.email_templates
+        data = dict(self.data)
+        data['cc'] = []
+        data['bcc'] = []
+
+        for part in ('subject', 'text', 'html'):
+            if data[part] is not None:
+                templates.check_outputs(data[part], keys)
+
+        for part, suffix in (('text', ''), ('html', '__html')):
+            if data[part] is not None:
+                context = dict(substitution or {})
+                context.update({key: '%recipient.{0}{1}%'.format(key, suffix) for key in keys})
+                context['subject'] = templates.render(self.data['subject'], context)
+                data[part] = templates.render(data[part], context)
+
+        context = dict(substitution or {})
+        context.update({key: '%recipient.{0}%'.format(key) for key in keys})
+        data['subject'] = templates.render(self.data['subject'], context)
+
+        if send_at:
+            data['o:deliverytime'] = send_at.strftime('%a, %d %b %Y %H:%M:%S') + ' GMT'
+
+        return data
+
+    def _send(self, data, send_at=None):
         if send_at:
             # @see http://stackoverflow.com/questions/3453177/convert-python-datetime-to-rfc-2822
             # Thu, 13 Oct 2011 18:02:00 GMT
-            self.data['o:deliverytime'] = send_at.strftime('%a, %d %b %Y %H:%M:%S') + ' GMT'
+            data['o:deliverytime'] = send_at.strftime('%a, %d %b %Y %H:%M:%S') + ' GMT'
 
-        debug_mode = False
-        if current_app.config.get('MAILGUN_API_KEY', None) is None:
-            debug_mode = True
+        return self._post(data)
 
-        if current_app.debug:
-            debug_mode = True
+    @classmethod
+    def is_mocked(cls):
+        """True when emails are only logged (in debug or without MAILGUN_API_KEY)"""
+        return current_app.config.get('MAILGUN_API_KEY', None) is None or current_app.debug
 
-        if debug_mode:
+    def _post(self, data):
+        if self.is_mocked():
             current_app.logger.info('MOCK MAILER')
-            current_app.logger.info(json.dumps(self.data, indent=4))
+            current_app.logger.info(json.dumps(data, indent=4))
         else:
-            requests.packages.urllib3.disable_warnings()
             r = None
+            headers = {}
+            if self.files:
+                # Streamed, a new body for each attempt
+                data = MultipartEncoder(data, self.files)
+                headers['Content-Type'] = data.content_type
+
             try:
-                r = requests.post(
+                r = current_app.http.post(
+                    'mailgun',
                     "{0}/messages".format(current_app.config['MAILGUN_API_URL']),
                     auth=('api', current_app.config['MAILGUN_API_KEY']),
-                    data=self.data,
-                    files=self.files,
-                    verify=False,
-                    timeout=20
+                    data=data,
+                    headers=headers
                 )
                 r.raise_for_status()
                 return r.json()
@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+
+from sentry_sdk import capture_exception
+from werkzeug.http import dump_cookie
+from werkzeug.wrappers import Request
+import datetime, re
+
+CORS_HEADERS = [
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', 'HEAD, GET, POST, PUT, DELETE, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Origin, X-Requested-With, Content-Type, Accept, Host, Authorization')
+]
+
+
+def _rule_pattern(rule):
+    """
+    Regular expression matching the paths of a URL rule, like /v<int:api_version>/t/page.gif
+    """
+    pattern, position = '^', 0
+    for variable in re.finditer(r'<(?:(\w+)(?:\(.*?\))?:)?\w+>', rule):
+        pattern += re.escape(rule[position:variable.start()]) + (r'\d+' if variable.group(1) == 'int' else '[^/]+')
+        position = variable.end()
+
+    return re.compile(pattern + re.escape(rule[position:]) + '$')
+
+
+class FastPathMiddleware(object):
+    """
+    Serves the hottest endpoints straight from WSGI, skipping Flask routing and hooks:
+      * /ping
+      * page.gif of the ganalytics blueprint (when registered, at its url_prefix), only the hit
+        is built and handed to the analytics dispatcher
+    Bodies and headers are built once, any other request goes to the Flask application.
+    """
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+
+        self.ping_body = 'Pong ({} v1)'.format(app.config.get('APPLICATION_NAME')).encode('utf-8')
+        self.ping_headers = [
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Content-Length', str(len(self.ping_body)))
+        ] + CORS_HEADERS
+
+        # Same path as the Flask view, url_prefix of the blueprint included
+        rule = next((rule.rule for rule in app.url_map.iter_rules() if rule.endpoint.startswith('ganalytics.') and rule.rule.endswith('/page.gif')), None)
+        self.tracking = rule is not None
+        if self.tracking:
+            from ganalytics.views import PIXEL, PIXEL_HEADERS
+            self.pixel_path = _rule_pattern(rule)
+            self.pixel_body = PIXEL
+            self.pixel_headers = PIXEL_HEADERS + [('Content-Length', str(len(PIXEL)))] + CORS_HEADERS
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD')
+        if method == 'GET' or method == 'HEAD':
+            path = environ.get('PATH_INFO', '')
+            if path == '/ping':
+                start_response('200 OK', list(self.ping_headers))
+                return [] if method == 'HEAD' else [self.ping_body]
+
+            if self.tracking and self.pixel_path.match(path):
+                try:
+                    return self.pageview(environ, start_response, method)
+                except Exception as e:
+                    # Flask error handlers don't see this path, the pixel is served anyway
+                    self.app.logger.exception('Unable to track the pageview')
+                    capture_exception(e)
+                    start_response('200 OK', list(self.pixel_headers))
+                    return [] if method == 'HEAD' else [self.pixel_body]
+
+        return self.wsgi_app(environ, start_response)
+
+    def pageview(self, environ, start_response, method):
+        from ganalytics.ga import Tracker
+        from ganalytics.views import COOKIE_LIFETIME
+
+        request = Request(environ)
+        tracker = Tracker('app', self.app.config)
+        tracker._load_from_request(request, self.app.geoip)
+        tracker.hit(
+            'pageview',
+            request.args.get('u', None) or request.headers.get('referer'),
+            request.args.get('r', None),
+            request.args.get('t', None)
+        )
+
+        if tracker.tid is not None:
+            self.app.ga_dispatcher.submit(tracker.payload())
+
+        headers = list(self.pixel_headers)
+        if request.cookies.get('_t') is None:
+            headers.append(('Set-Cookie', dump_cookie('_t', tracker.cid, expires=datetime.datetime.now() + COOKIE_LIFETIME)))
+
+        start_response('200 OK', headers)
+        return [] if method == 'HEAD' else [self.pixel_body]
@@ -1,11 +1,36 @@
 # -*- config:utf-8 -*-
 
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from utils.forms import BaseForm
 from database import db
 import sqlalchemy.types as types
 import datetime
 
 
+def after_commit(callback):
+    """
+    Calls callback once the current transaction is committed (never if it's rolled back).
+    No SQL can be emitted from it.
+    """
+    db.session.info.setdefault('after_commit', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_after_commit(session):
+    for callback in session.info.pop('after_commit', []):
+        try:
+            callback()
+        except Exception:
+            current_app.logger.exception('Exception in after commit callback')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_commit(session):
+    session.info.pop('after_commit', None)
+
+
 class ORModel(object):
     @classmethod
     def create(cls, form=None, **kwargs):
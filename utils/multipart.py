@@ -0,0 +1,107 @@
+# -*- coding:utf-8 -*-
+
+import io, os, pathlib, uuid
+
+
+class MultipartEncoder(object):
+    """
+    multipart/form-data body read by chunks, the files being streamed from their source.
+
+    `fields` maps names to a value or a list of values (None values are skipped),
+    `files` maps names to (filename, source, content type), the source being bytes, str (sent
+    UTF-8 encoded), a pathlib.Path or a seekable file-like object (sent from its start).
+    The total size is known in advance (len()), so requests sends it with a Content-Length.
+    """
+    def __init__(self, fields, files, chunk_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.parts = []
+
+        for name, values in fields.items():
+            for value in (values if isinstance(values, (list, tuple)) else [values]):
+                if value is None:
+                    continue
+
+                headers = 'Content-Disposition: form-data; name="{0}"'.format(name)
+                self.parts.append((self._headers(headers), str(value).encode('utf-8')))
+
+        for name, (filename, source, content_type) in files.items():
+            headers = 'Content-Disposition: form-data; name="{0}"; filename="{1}"\r\nContent-Type: {2}'.format(
+                name, filename.replace('"', ''), content_type or 'application/octet-stream'
+            )
+            self.parts.append((self._headers(headers), source))
+
+        self.footer = '--{0}--\r\n'.format(self.boundary).encode('utf-8')
+        self.length = sum(len(headers) + self._size(source) + 2 for headers, source in self.parts) + len(self.footer)
+        self._chunks = None
+        self._chunk = b''
+        self._offset = 0
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={0}'.format(self.boundary)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for headers, source in self.parts:
+            yield headers
+            if isinstance(source, (bytes, bytearray)):
+                yield bytes(source)
+            elif isinstance(source, str):
+                yield source.encode('utf-8')
+            elif isinstance(source, pathlib.PurePath):
+                with open(source, 'rb') as f:
+                    yield from self._stream(f)
+            else:
+                source.seek(0)
+                yield from self._stream(source)
+
+            yield b'\r\n'
+
+        yield self.footer
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = iter(self)
+
+        # Views on the current chunk, which is never copied but once in the result
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, b'')
+                self._offset = 0
+                if not self._chunk:
+                    break
+
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            parts.append(memoryview(self._chunk)[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+
+        return b''.join(parts)
+
+    def _stream(self, f):
+        while True:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def _headers(self, headers):
+        return '--{0}\r\n{1}\r\n\r\n'.format(self.boundary, headers).encode('utf-8')
+
+    def _size(self, source):
+        if isinstance(source, (bytes, bytearray)):
+            return len(source)
+
+        if isinstance(source, str):
+            return len(source.encode('utf-8'))
+
+        if isinstance(source, pathlib.PurePath):
+            return os.path.getsize(source)
+
+        source.seek(0, io.SEEK_END)
+        return source.tell()
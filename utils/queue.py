@@ -1,21 +1,113 @@
 # -*- coding:utf-8 -*-
-import json, logging
+from utils.codec import Codec
+import datetime, calendar, hashlib, logging, os, time
+
+# Moves the delayed items that are due to the queue: KEYS = delayed, queue; ARGV = now, limit
+# Members are "<unique id>|<item>" so identical items can be scheduled more than once
+PROMOTE_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #items == 0 then
+    return 0
+end
+
+local ready = {}
+for i, item in ipairs(items) do
+    ready[i] = string.sub(item, string.find(item, '|', 1, true) + 1)
+end
+
+redis.call('ZREM', KEYS[1], unpack(items))
+redis.call('RPUSH', KEYS[2], unpack(ready))
+return #items
+"""
+
+# Requeues the items of a stalled worker, counting it as an attempt:
+# KEYS = processing, queue, attempts, dead; ARGV = max attempts
+# Attempts are counted by job id (see RedisQueue._job_id)
+REQUEUE_SCRIPT = """
+local function job_id(item)
+    if string.byte(item, 1) == 1 then
+        local hex = {}
+        for i = 2, 9 do
+            hex[#hex + 1] = string.format('%02x', string.byte(item, i))
+        end
+        return table.concat(hex)
+    end
+    return redis.sha1hex(item)
+end
+
+local requeued = 0
+while true do
+    local item = redis.call('RPOP', KEYS[1])
+    if not item then
+        break
+    end
+
+    local id = job_id(item)
+    local attempts = redis.call('HINCRBY', KEYS[3], id, 1)
+    if attempts >= tonumber(ARGV[1]) then
+        redis.call('HDEL', KEYS[3], id)
+        redis.call('RPUSH', KEYS[4], item)
+    else
+        redis.call('LPUSH', KEYS[2], item)
+        requeued = requeued + 1
+    end
+end
+return requeued
+"""
+
+# First byte of the items with a job id, neither JSON text nor a codec header starts with it
+JOB_ID_MARKER = b'\x01'
 
 try:
     import redis
 
     class RedisQueue(object):
-        """Simple Queue with Redis Backend"""
-        def __init__(self, namespace, redis_url):
+        """
+        Simple Queue with Redis Backend
+
+        Besides get(), items can be consumed at least once: reserve() moves the item to a processing
+        list of the worker, where it stays until ack() or fail(). Workers send heartbeats, and
+        reap() puts back in the queue the items of the workers that stopped sending them.
+        Failed items are retried with an exponential backoff, and moved to the `<queue>:dead`
+        list after max_attempts.
+
+        Items are stored as 0x01, a random 8 bytes job id then the encoded item, so the attempts
+        of identical jobs are counted apart. Items queued without id are still read.
+        """
+        def __init__(self, namespace, redis_url, codec=None):
             self.redis_url = redis_url
             self.namespace = namespace
+            self.codec = codec or Codec()
             self.__db = redis.from_url(redis_url)
+            self.__promote = self.__db.register_script(PROMOTE_SCRIPT)
+            self.__requeue = self.__db.register_script(REQUEUE_SCRIPT)
+
+        def put(self, queue, item, delay=None, eta=None):
+            """
+            Put item into the queue
+            With delay (seconds) or eta (datetime in UTC or timestamp), the item is kept in the
+            `<queue>:delayed` sorted set until then, see promote()
+            """
+
+            key = '{0}:{1}'.format(self.namespace, queue,)
+            if delay is None and eta is None:
+                self.__db.rpush(key, self._encode(item))
+                return None
+
+            if isinstance(eta, datetime.datetime):
+                eta = calendar.timegm(eta.utctimetuple()) + eta.microsecond / 1000000
+
+            self._schedule(key, self._encode(item), eta if eta is not None else time.time() + delay)
 
-        def put(self, queue, item):
-            """ Put item into the queue """
+        def put_many(self, queue, items, chunk_size=1000):
+            """ Put items into the queue, with one RPUSH per chunk_size items, in a single round-trip """
 
             key = '{0}:{1}'.format(self.namespace, queue,)
-            self.__db.rpush(key, json.dumps(item))
+            items = [self._encode(item) for item in items]
+            p = self.__db.pipeline(transaction=False)
+            for i in range(0, len(items), chunk_size):
+                p.rpush(key, *items[i:i + chunk_size])
+            p.execute()
 
         def get(self, queue, timeout=None):
             """Remove and return an item from the queue."""
@@ -23,18 +115,190 @@ try:
             item = self.__db.blpop(keys, timeout=timeout)
 
             if item is not None:
-                try:
-                    item = json.loads(item[1])
-                except ValueError as e:
-                    logging.exception("[ERROR JSON (in queue)] - {1} => {0}\n".format(str(e), str(item)))
-                    return None
+                return self._decode(item[1])
 
             return item
 
+        def get_any(self, queues, timeout=None):
+            """
+            Remove and return an item from the first non empty queue, as (queue, item),
+            with a single BLPOP on all of them
+            """
+            keys = {'{0}:{1}'.format(self.namespace, queue): queue for queue in queues}
+            item = self.__db.blpop(list(keys), timeout=timeout)
+            if item is None:
+                return None
+
+            item = (keys[item[0].decode('utf-8')], self._decode(item[1]))
+            return item if item[1] is not None else None
+
+        def get_many(self, queue, count, timeout=None):
+            """
+            Remove and return up to count items from the queue, in order.
+            When the queue is empty, waits up to timeout seconds (forever if None, not at all if 0) for a first item.
+            """
+            key = '{0}:{1}'.format(self.namespace, queue)
+            p = self.__db.pipeline()
+            p.lrange(key, 0, count - 1)
+            p.ltrim(key, count, -1)
+            items = p.execute()[0]
+
+            if not items and timeout != 0:
+                item = self.__db.blpop(key, timeout=timeout)
+                if item is None:
+                    return []
+
+                items = [item[1]]
+                if count > 1:
+                    p = self.__db.pipeline()
+                    p.lrange(key, 0, count - 2)
+                    p.ltrim(key, count - 1, -1)
+                    items += p.execute()[0]
+
+            items = [self._decode(item) for item in items]
+            return [item for item in items if item is not None]
+
+        def reserve(self, queue, worker, timeout=None):
+            """
+            Moves the first item of the queue to the processing list of the worker.
+            Returns (raw, item), raw being what to give to ack() or fail(), or None on timeout.
+            """
+            key = '{0}:{1}'.format(self.namespace, queue)
+            raw = self.__db.blmove(key, self._processing(queue, worker), timeout or 0, 'LEFT', 'RIGHT')
+            if raw is None:
+                return None
+
+            item = self._decode(raw)
+            if item is None:
+                p = self.__db.pipeline()
+                p.lrem(self._processing(queue, worker), 1, raw)
+                p.rpush('{0}:dead'.format(key), raw)
+                p.execute()
+                return None
+
+            return raw, item
+
+        def ack(self, queue, worker, raw):
+            key = '{0}:{1}'.format(self.namespace, queue)
+            p = self.__db.pipeline()
+            p.lrem(self._processing(queue, worker), 1, raw)
+            p.hdel('{0}:attempts'.format(key), self._job_id(raw))
+            p.execute()
+
+        def fail(self, queue, worker, raw, max_attempts=5, backoff=10):
+            """
+            Retries the item in backoff * 2^(attempts - 1) seconds, or moves it to the dead-letter list.
+            Returns True when the item has been retried.
+            """
+            key = '{0}:{1}'.format(self.namespace, queue)
+            job_id = self._job_id(raw)
+            attempts = self.__db.hincrby('{0}:attempts'.format(key), job_id, 1)
+
+            p = self.__db.pipeline()
+            p.lrem(self._processing(queue, worker), 1, raw)
+            if attempts >= max_attempts:
+                p.hdel('{0}:attempts'.format(key), job_id)
+                p.rpush('{0}:dead'.format(key), raw)
+            else:
+                self._schedule(key, raw, time.time() + backoff * 2 ** (attempts - 1), p)
+            p.execute()
+
+            return attempts < max_attempts
+
+        def release(self, queue, worker, raw):
+            """Puts back a reserved item at the head of the queue, without counting an attempt"""
+            key = '{0}:{1}'.format(self.namespace, queue)
+            p = self.__db.pipeline()
+            p.lrem(self._processing(queue, worker), 1, raw)
+            p.lpush(key, raw)
+            p.execute()
+
+        def heartbeat(self, queue, worker):
+            self.__db.zadd('{0}:{1}:workers'.format(self.namespace, queue), {worker: time.time()})
+
+        def reap(self, queue, visibility_timeout, max_attempts=5):
+            """
+            Requeues the items of the workers without heartbeat for visibility_timeout seconds.
+            Returns the number of items requeued.
+            """
+            key = '{0}:{1}'.format(self.namespace, queue)
+            workers = '{0}:workers'.format(key)
+            requeued = 0
+            for worker in self.__db.zrangebyscore(workers, '-inf', time.time() - visibility_timeout):
+                worker = worker.decode('utf-8')
+                requeued += self.__requeue(
+                    keys=[self._processing(queue, worker), key, '{0}:attempts'.format(key), '{0}:dead'.format(key)],
+                    args=[max_attempts]
+                )
+                self.__db.zrem(workers, worker)
+
+            return requeued
+
+        def retire(self, queue, worker):
+            """
+            Removes a worker that stopped cleanly. The items still in its processing list (failed ack...)
+            would never be reaped: they are put back at the head of the queue, in order, without counting
+            an attempt. Returns their number.
+            """
+            key = '{0}:{1}'.format(self.namespace, queue)
+            requeued = 0
+            while self.__db.lmove(self._processing(queue, worker), key, 'RIGHT', 'LEFT') is not None:
+                requeued += 1
+
+            self.__db.zrem('{0}:workers'.format(key), worker)
+            return requeued
+
+        def promote(self, queue, limit=1000):
+            """
+            Moves the delayed items that are due to the queue, by batches of `limit`, returns their number.
+            Only the due items are read (range by score), whatever the number of pending ones.
+            """
+            key = '{0}:{1}'.format(self.namespace, queue)
+            promoted, now = 0, time.time()
+            while True:
+                count = self.__promote(keys=['{0}:delayed'.format(key), key], args=[now, limit])
+                promoted += count
+                if count < limit:
+                    return promoted
+
+        def _schedule(self, key, raw, timestamp, pipeline=None):
+            if isinstance(raw, str):
+                raw = raw.encode('utf-8')
+
+            member = os.urandom(8).hex().encode('ascii') + b'|' + raw
+            (pipeline or self.__db).zadd('{0}:delayed'.format(key), {member: timestamp})
+
+        def _processing(self, queue, worker):
+            return '{0}:{1}:processing:{2}'.format(self.namespace, queue, worker)
+
+        def _encode(self, item):
+            return JOB_ID_MARKER + os.urandom(8) + self.codec.encode(item)
+
+        def _job_id(self, raw):
+            """Id of the job the attempts are counted by, the hash of the item when queued without id"""
+            if raw[0:1] == JOB_ID_MARKER:
+                return raw[1:9].hex()
+
+            return hashlib.sha1(raw).hexdigest()
+
+        def _decode(self, item):
+            if item[0:1] == JOB_ID_MARKER:
+                item = item[9:]
+
+            try:
+                return self.codec.decode(item)
+            except ValueError as e:
+                logging.exception("[ERROR DECODING (in queue)] - {1} => {0}\n".format(str(e), str(item)))
+                return None
+
         def pipeline(self):
             return self.__db.pipeline()
 
+        def connection(self):
+            """Underlying redis client, for the components sharing this connection pool"""
+            return self.__db
+
 except ImportError:
     class RedisQueue(object):
-        def __init__(self, namespace, redis_url):
+        def __init__(self, namespace, redis_url, codec=None):
             raise ModuleNotFoundError('Module redis not found on the server ...')
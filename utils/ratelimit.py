@@ -0,0 +1,275 @@
+# -*- coding:utf-8 -*-
+
+import hashlib, math, mmap, os, struct, threading, time, uuid
+
+
+"""
+Each script checks every key given in KEYS at once, ARGV being:
+    now (ms), then limit and period (ms) for each key.
+Nothing is recorded unless all the keys allow the request.
+They return {allowed, remaining, reset (ms from now)}
+"""
+
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tats = {}
+local remaining = -1
+local reset = 0
+local retry = 0
+
+for i = 1, #KEYS do
+    local limit = tonumber(ARGV[i * 2])
+    local period = tonumber(ARGV[i * 2 + 1])
+    local interval = period / limit
+    local tat = tonumber(redis.call('GET', KEYS[i]) or now)
+    if tat < now then
+        tat = now
+    end
+
+    local new_tat = tat + interval
+    local allow_at = new_tat - period
+    if now < allow_at then
+        retry = math.max(retry, allow_at - now)
+    else
+        local left = math.floor((now - allow_at) / interval)
+        if remaining < 0 or left < remaining then
+            remaining = left
+        end
+    end
+
+    tats[i] = new_tat
+    reset = math.max(reset, new_tat - now)
+end
+
+if retry > 0 then
+    return {0, 0, math.ceil(retry)}
+end
+
+for i = 1, #KEYS do
+    redis.call('SET', KEYS[i], tostring(tats[i]), 'PX', math.ceil(tats[i] - now))
+end
+
+return {1, remaining, math.ceil(reset)}
+"""
+
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local member = ARGV[#ARGV]
+local remaining = -1
+local reset = 0
+local retry = 0
+
+for i = 1, #KEYS do
+    local limit = tonumber(ARGV[i * 2])
+    local period = tonumber(ARGV[i * 2 + 1])
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - period)
+
+    local count = redis.call('ZCARD', KEYS[i])
+    if count >= limit then
+        local oldest = redis.call('ZRANGE', KEYS[i], 0, count - limit, 'WITHSCORES')
+        retry = math.max(retry, tonumber(oldest[#oldest]) + period - now)
+    else
+        local left = limit - count - 1
+        if remaining < 0 or left < remaining then
+            remaining = left
+        end
+    end
+end
+
+if retry > 0 then
+    return {0, 0, math.ceil(retry)}
+end
+
+for i = 1, #KEYS do
+    local period = tonumber(ARGV[i * 2 + 1])
+    redis.call('ZADD', KEYS[i], now, member)
+    redis.call('PEXPIRE', KEYS[i], period)
+    reset = math.max(reset, period)
+end
+
+return {1, remaining, reset}
+"""
+
+
+class RateLimit(object):
+    """
+    Outcome of a rate limit check, as exposed in the X-RateLimit-* headers
+    """
+    def __init__(self, limit, remaining, reset, over_limit=False):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset  # Timestamp at which the limit will be fully restored (or retry is allowed when over limit)
+        self.over_limit = over_limit
+
+
+class RedisLimiter(object):
+    """
+    Checks several keys in a single round-trip via a Lua script (EVALSHA, loaded on first use).
+    Algorithms:
+      * gcra: Generic Cell Rate Algorithm, one value per key, evenly spaced requests
+      * sliding-window: exact log of the requests made during the period, one sorted set per key
+    """
+    scripts = {
+        'gcra': GCRA_SCRIPT,
+        'sliding-window': SLIDING_WINDOW_SCRIPT
+    }
+
+    def __init__(self, connection, namespace=None, algorithm='gcra'):
+        if algorithm not in self.scripts:
+            raise ValueError('Unknown rate limit algorithm "{0}".'.format(algorithm))
+
+        self.namespace = namespace
+        self.script = connection.register_script(self.scripts[algorithm])
+
+    def check(self, rules, period=60):
+        """
+        rules: list of (key, limit) - limit being the number of requests allowed per period (seconds)
+        """
+        now = int(time.time() * 1000)
+        keys, args = [], [now]
+        for key, limit in rules:
+            keys.append('{0}:{1}'.format(self.namespace, key) if self.namespace else key)
+            args.extend([limit, period * 1000])
+
+        args.append('{0}-{1}'.format(now, uuid.uuid4().hex))
+        allowed, remaining, reset = self.script(keys=keys, args=args)
+        return RateLimit(
+            min(limit for key, limit in rules),
+            int(remaining),
+            int(math.ceil((now + int(reset)) / 1000)),
+            over_limit=not allowed
+        )
+
+
+class SharedMemoryLimiter(object):
+    """
+    GCRA limiter keeping its state in a memory mapped file (put it in /dev/shm),
+    shared by every worker process of the host. Used when Redis is not configured.
+
+    The table is made of buckets of `ways` slots, each slot being (key hash, theoretical arrival time).
+    A slot whose arrival time is in the past holds no state anymore and is reused on the next lookup.
+    When a bucket is full, the slot the closest to expiration is evicted.
+    Buckets are guarded by striped locks: a thread lock and a fcntl lock on the matching byte of the file.
+
+    The geometry is part of the file name (<path>-<buckets>x<ways>): resizing a file mapped by
+    running workers would crash them (SIGBUS), so changing it starts a new table instead.
+    POSIX only.
+    """
+    slot = struct.Struct('<Qd')
+
+    def __init__(self, path, buckets=4096, ways=16, stripes=64):
+        self.path = '{0}-{1}x{2}'.format(path, buckets, ways)
+        self.buckets = buckets
+        self.ways = ways
+        self.stripes = stripes
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def check(self, rules, period=60):
+        now = time.time()
+        table = self._table()
+        hashes = [self._hash(key) for key, limit in rules]
+        stripes = sorted(set((h % self.buckets) % self.stripes for h in hashes))
+
+        self._acquire(stripes)
+        try:
+            updates = []
+            remaining, reset, retry = None, 0, 0
+            for h, (key, limit) in zip(hashes, rules):
+                offset = self._find(table, h, now, [u[0] for u in updates])
+                stored_hash, tat = self.slot.unpack_from(table, offset)
+                if stored_hash != h or tat < now:
+                    tat = now
+
+                interval = period / limit
+                new_tat = tat + interval
+                allow_at = new_tat - period
+                if now < allow_at:
+                    retry = max(retry, allow_at - now)
+                else:
+                    left = int((now - allow_at) // interval)
+                    remaining = left if remaining is None else min(remaining, left)
+
+                updates.append((offset, h, new_tat))
+                reset = max(reset, new_tat - now)
+
+            limit = min(limit for key, limit in rules)
+            if retry > 0:
+                return RateLimit(limit, 0, int(math.ceil(now + retry)), over_limit=True)
+
+            for offset, h, new_tat in updates:
+                self.slot.pack_into(table, offset, h, new_tat)
+        finally:
+            self._release(stripes)
+
+        return RateLimit(limit, remaining, int(math.ceil(now + reset)))
+
+    def _find(self, table, h, now, taken):
+        """
+        Offset of the slot holding h, or of the slot to use for it in its bucket
+        """
+        start = (h % self.buckets) * self.ways * self.slot.size
+        free, oldest, oldest_tat = None, None, None
+        for offset in range(start, start + self.ways * self.slot.size, self.slot.size):
+            if offset in taken:
+                continue
+
+            stored_hash, tat = self.slot.unpack_from(table, offset)
+            if stored_hash == h:
+                return offset
+
+            if free is None and (stored_hash == 0 or tat < now):
+                free = offset
+            elif oldest is None or tat < oldest_tat:
+                oldest, oldest_tat = offset, tat
+
+        return free if free is not None else oldest
+
+    def _hash(self, key):
+        # The builtin hash() is salted per process, we need the same value in every worker
+        h = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        return h or 1
+
+    def _acquire(self, stripes):
+        import fcntl
+        # Always in ascending order, to avoid deadlocks between rules sharing stripes
+        for stripe in stripes:
+            self._locks[stripe].acquire()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+
+    def _release(self, stripes):
+        import fcntl
+        for stripe in reversed(stripes):
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+            self._locks[stripe].release()
+
+    def _table(self):
+        # Locks and file descriptors aren't shared with forked workers, each process opens its own mapping
+        if self._pid == os.getpid():
+            return self._map
+
+        import fcntl
+        with self._lock:
+            if self._pid != os.getpid():
+                size = self.buckets * self.ways * self.slot.size
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    current = os.fstat(fd).st_size
+                    if current == 0:
+                        # Just created, nobody can have it mapped yet
+                        os.ftruncate(fd, size)
+                        current = size
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+                if current != size:
+                    os.close(fd)
+                    raise ValueError('{0} is {1} bytes instead of {2}, remove it to start a new table.'.format(self.path, current, size))
+
+                self._fd = fd
+                self._map = mmap.mmap(fd, size)
+                self._locks = [threading.Lock() for i in range(self.stripes)]
+                self._pid = os.getpid()
+
+        return self._map
@@ -0,0 +1,351 @@
+# -*- coding:utf-8 -*-
+
+from flask import current_app
+from utils.cache import LRUCache, SingleFlight
+import base64, calendar, hashlib, hmac, json, os, time, uuid
+
+
+SIGNED_PREFIX = 's1'
+
+
+def sign_token(secret, account_id, expires):
+    """
+    Creates a self contained session token: s1.<account id>.<issued ms>.<expires>.<nonce>.<signature>
+    (numbers in hexadecimal, expires being a timestamp)
+    Raises ValueError without secret, anyone could sign tokens otherwise.
+    """
+    if not secret:
+        raise ValueError('A secret is required to sign tokens.')
+
+    payload = '{0}.{1:x}.{2:x}.{3:x}.{4}'.format(SIGNED_PREFIX, account_id, int(time.time() * 1000), expires, os.urandom(6).hex())
+    return '{0}.{1}'.format(payload, _signature(secret, payload))
+
+
+def read_token(secret, token):
+    """
+    Returns the content of a signed token, or None when it's invalid or expired (always without secret)
+    """
+    if not secret:
+        return None
+
+    try:
+        payload, signature = token.rsplit('.', 1)
+        prefix, account_id, issued, expires, nonce = payload.split('.')
+        account_id, issued, expires = int(account_id, 16), int(issued, 16), int(expires, 16)
+    except ValueError:
+        return None
+
+    # compare_digest only takes ASCII str
+    if prefix != SIGNED_PREFIX or not hmac.compare_digest(signature.encode('utf-8'), _signature(secret, payload).encode('utf-8')):
+        return None
+
+    if expires < time.time():
+        return None
+
+    return {'account_id': account_id, 'issued': issued, 'expires': expires, 'nonce': nonce}
+
+
+def is_signed(token):
+    return token[0:len(SIGNED_PREFIX) + 1] == SIGNED_PREFIX + '.'
+
+
+def _signature(secret, payload):
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+
+    digest = hmac.new(secret, payload.encode('utf-8'), hashlib.sha256).digest()[0:18]
+    return base64.urlsafe_b64encode(digest).decode('utf-8')
+
+
+class BloomFilter(object):
+    def __init__(self, bits=1 << 20, hashes=7):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray(bits // 8)
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[0:8], 'little'), int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+
+class RevocationFilter(object):
+    """
+    Revocations of signed tokens, either a single token (by nonce) or every token of an account
+    issued before a given time.
+
+    They are stored in a Redis sorted set (member -> revocation time in ms) and every process
+    rebuilds a local Bloom filter from it each `interval` seconds. Redis is only queried when
+    the filter reports a token as (possibly) revoked, so other processes see a revocation
+    after `interval` seconds at most.
+    Without Redis, revocations are kept in the process only.
+    When Redis can't be queried, tokens reported by the filter are considered revoked (fail closed).
+    """
+    def __init__(self, interval=5, lifetime=30 * 86400):
+        self.interval = interval
+        self.lifetime = lifetime
+        self.filter = BloomFilter()
+        self.local = {}
+        self.synced = 0
+
+    def revoke(self, nonce):
+        self._add('t:{0}'.format(nonce))
+
+    def revoke_account(self, account_id):
+        self._add('a:{0}'.format(account_id))
+
+    def is_revoked(self, data):
+        self._sync()
+        for member in ('t:{0}'.format(data['nonce']), 'a:{0}'.format(data['account_id'])):
+            if member not in self.filter:
+                continue
+
+            redis = self._redis()
+            try:
+                revoked = self.local.get(member) if redis is None else redis.zscore(self._key(), member)
+            except Exception:
+                current_app.logger.exception('[RevocationFilter] Unable to check {0}, considered revoked'.format(member))
+                return True
+
+            if revoked is not None and data['issued'] <= revoked:
+                return True
+
+        return False
+
+    def _add(self, member):
+        now = int(time.time() * 1000)
+        self.filter.add(member)
+
+        redis = self._redis()
+        if redis is None:
+            self.local[member] = now
+        else:
+            redis.zadd(self._key(), {member: now})
+
+    def _sync(self):
+        if time.time() - self.synced < self.interval:
+            return None
+
+        self.synced = time.time()
+        redis = self._redis()
+        if redis is None:
+            return None
+
+        try:
+            p = redis.pipeline()
+            # Past the lifetime of a token, the revocation has no use anymore
+            p.zremrangebyscore(self._key(), '-inf', int((time.time() - self.lifetime) * 1000))
+            p.zrange(self._key(), 0, -1)
+            members = p.execute()[1]
+        except Exception:
+            current_app.logger.exception('[RevocationFilter] Unable to sync from Redis')
+            return None
+
+        bloom = BloomFilter(self.filter.bits, self.filter.hashes)
+        for member in members:
+            bloom.add(member.decode('utf-8'))
+
+        self.filter = bloom
+
+    def _key(self):
+        return '{0}:auth:revoked'.format(current_app.redis_queue.namespace)
+
+    def _redis(self):
+        if not hasattr(current_app, 'redis_queue'):
+            return None
+
+        return current_app.redis_queue.connection()
+
+
+class TokenResolver(object):
+    """
+    Resolves an authentication token (Bearer session or Basic API key) to its account.
+
+    Lookups go through a per-process LRU, then a snapshot stored in Redis (when configured)
+    and only then hit the database. Concurrent misses on the same token share a single query.
+    The local tier can't be invalidated from other processes, so keep its TTL short.
+
+    Signed session tokens (see sign_token) are verified without any I/O, only their account
+    goes through the cache.
+    """
+    def __init__(self, maxsize=10000, local_ttl=10, ttl=300, revocation_interval=5):
+        self.local = LRUCache(maxsize, local_ttl)
+        self.ttl = ttl
+        self.flight = SingleFlight()
+        self.revocations = RevocationFilter(revocation_interval)
+
+    def issue_session(self, account_id, expires):
+        """
+        Token to use for a new session: signed when SIGNED_TOKENS is enabled, random otherwise
+        """
+        if current_app.config.get('SIGNED_TOKENS'):
+            return sign_token(current_app.config.get('SECRET_KEY'), account_id, calendar.timegm(expires.utctimetuple()))
+
+        return str(uuid.uuid4()).replace('-', '')
+
+    def resolve_session(self, token):
+        if is_signed(token):
+            data = read_token(current_app.config.get('SECRET_KEY'), token)
+            if data is None or self.revocations.is_revoked(data):
+                return None
+
+            return self._resolve('signed:{0}'.format(data['account_id']), self._load_account, data['account_id'])
+
+        return self._resolve('session:{0}'.format(token), self._load_session, token)
+
+    def revoke_session(self, token):
+        """Logs out a session token (commits the current transaction)"""
+        from auth.models import Session
+        from database import db
+        if is_signed(token):
+            data = read_token(current_app.config.get('SECRET_KEY'), token)
+            if data is not None:
+                self.revocations.revoke(data['nonce'])
+
+        Session.query.filter(Session.token == token).delete()
+        db.session.commit()
+        self.invalidate_session(token)
+
+    def revoke_account(self, account_id):
+        """Revokes every signed token issued to this account until now"""
+        self.revocations.revoke_account(account_id)
+        self.invalidate_account(account_id)
+
+    def resolve_api_key(self, token):
+        return self._resolve('api:{0}'.format(token), self._load_api_key, token)
+
+    def invalidate_session(self, *tokens):
+        self._invalidate(*['session:{0}'.format(token) for token in tokens])
+
+    def invalidate_api_key(self, token):
+        self._invalidate('api:{0}'.format(token))
+
+    def invalidate_account(self, account_id):
+        """Drops every cached token belonging to the given account"""
+        if account_id is None:
+            return None
+
+        self.local.delete_if(lambda snapshot: snapshot['account']['id'] == account_id)
+
+        redis = self._redis()
+        if redis is None:
+            return None
+
+        index = self._key('account:{0}'.format(account_id))
+        try:
+            redis.delete(index, *redis.smembers(index))
+        except Exception:
+            current_app.logger.exception('[TokenResolver] Unable to invalidate account {0}'.format(account_id))
+
+    def _resolve(self, key, loader, token):
+        snapshot = self.local.get(key)
+        if snapshot is None:
+            snapshot = self.flight.do(key, self._fetch, key, loader, token)
+            if snapshot is None:
+                return None
+
+            ttl = self._ttl(snapshot, self.local.ttl)
+            if ttl > 0:
+                self.local.set(key, snapshot, ttl)
+
+        from accounts.models import Account
+        return Account.from_snapshot(snapshot['account'])
+
+    def _fetch(self, key, loader, token):
+        redis = self._redis()
+        if redis is not None:
+            try:
+                cached = redis.get(self._key(key))
+                if cached is not None:
+                    return json.loads(cached)
+            except Exception:
+                current_app.logger.exception('[TokenResolver] Unable to read from Redis')
+                redis = None
+
+        snapshot = loader(token)
+        if snapshot is None or redis is None:
+            return snapshot
+
+        ttl = self._ttl(snapshot, self.ttl)
+        if ttl > 0:
+            index = self._key('account:{0}'.format(snapshot['account']['id']))
+            try:
+                p = redis.pipeline()
+                p.set(self._key(key), json.dumps(snapshot), ex=ttl)
+                p.sadd(index, self._key(key))
+                p.expire(index, self.ttl)
+                p.execute()
+            except Exception:
+                current_app.logger.exception('[TokenResolver] Unable to write to Redis')
+
+        return snapshot
+
+    def _invalidate(self, *keys):
+        if not keys:
+            return None
+
+        for key in keys:
+            self.local.delete(key)
+
+        redis = self._redis()
+        if redis is not None:
+            try:
+                redis.delete(*[self._key(key) for key in keys])
+            except Exception:
+                current_app.logger.exception('[TokenResolver] Unable to invalidate {0}'.format(', '.join(keys)))
+
+    def _load_session(self, token):
+        from auth.models import Session
+        session = Session.find_by_token(token)
+        if session is None:
+            return None
+
+        return {
+            'account': session.account.snapshot(),
+            'expires': calendar.timegm(session.expires.utctimetuple())
+        }
+
+    def _load_account(self, account_id):
+        from accounts.models import Account
+        account = Account.query.filter(Account.id == account_id).filter(Account.removed == None).first()  # noqa
+        if account is None:
+            return None
+
+        return {
+            'account': account.snapshot(),
+            'expires': None
+        }
+
+    def _load_api_key(self, token):
+        from accounts.models import ApiKey
+        account = ApiKey.account_by_token(token)
+        if account is None:
+            return None
+
+        return {
+            'account': account.snapshot(),
+            'expires': None
+        }
+
+    def _ttl(self, snapshot, ttl):
+        """Never keep a session longer than its own expiration"""
+        if snapshot['expires'] is None:
+            return ttl
+
+        return int(min(ttl, snapshot['expires'] - time.time()))
+
+    def _key(self, key):
+        return '{0}:auth:{1}'.format(current_app.redis_queue.namespace, key)
+
+    def _redis(self):
+        if not hasattr(current_app, 'redis_queue'):
+            return None
+
+        return current_app.redis_queue.connection()